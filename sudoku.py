@@ -1,17 +1,497 @@
 import sys
 import random
-from collections import deque
+from collections import deque, OrderedDict
+import multiprocessing
+import mmap
+import os
+import stat
 import time
+from itertools import combinations, islice, permutations
+
+try:
+    from queue import Empty
+except ImportError:
+    # Python 2
+    from Queue import Empty
+
+try:
+    import numpy
+except ImportError:
+    # Batch mode falls back to solving puzzles one at a time
+    numpy = None
 
 
 # Running script: given code can be run with the command:
 # python file.py, ./path/to/init_state.txt ./output/output.txt
+# or, to solve a file with one puzzle per line using all cores ('-' for stdin / stdout):
+# python file.py --batch [--mmap] [--cache ./path/to/cache.txt] ./path/to/puzzles.txt ./output/solutions.txt
+# or, to race several heuristic configurations on one puzzle in separate processes:
+# python file.py --portfolio ./path/to/init_state.txt ./output/output.txt
+# or, to split the search for one hard puzzle across all cores:
+# python file.py --parallel ./path/to/init_state.txt ./output/output.txt
+# or, to generate puzzles with a unique solution, one per line:
+# python file.py --generate COUNT [--clues N] [--symmetry rotational|diagonal] [--seed S] ./output/puzzles.txt
+
+# Number of puzzles sent to a worker process at a time in batch mode
+BATCH_CHUNK_SIZE = 64
+# Number of puzzles sent to a worker process at a time in batch mode when numpy is available, so
+# that each worker propagates many puzzles per array operation
+VECTORIZED_CHUNK_SIZE = 1024
+# Number of chunks per worker process that may be queued or unwritten at any time in batch mode
+BATCH_CHUNKS_PER_PROCESS = 4
+
+# Subproblems per worker process made by the parallel search, so that a worker finishing an easy
+# subproblem early takes another instead of sitting idle
+PARALLEL_SUBPROBLEMS_PER_PROCESS = 8
+# Seconds solve_portfolio waits for a result before checking whether a member died without one
+PORTFOLIO_POLL_INTERVAL = 0.5
+# Deepest level of the search tree expanded into subproblems by the parallel search
+PARALLEL_MAX_SPLIT_DEPTH = 6
+
+# Most solutions kept by a SolutionCache, least recently used ones are dropped first
+CACHE_MAX_ENTRIES = 100000
+# Largest order looked up in a SolutionCache. The canonical form tries (order!) ** 2 * 2
+# symmetry transforms, too many to build or scan per puzzle for 25x25 boards and up
+CACHE_MAX_ORDER = 4
+
+# Number of puzzles generated by a worker process at a time in generate mode
+GENERATE_CHUNK_SIZE = 16
+
+# Clue removal patterns of the puzzle generator: cells are removed alone, together with the
+# cell rotated 180 degrees about the centre, or together with the cell mirrored in the diagonal
+NO_SYMMETRY = 0
+ROTATIONAL_SYMMETRY = 1
+DIAGONAL_SYMMETRY = 2
+
+# Largest nogood recorded by conflict directed backjumping; bigger ones rarely match again
+MAX_NOGOOD_SIZE = 3
+
+# Largest value written as a letter (Z), so boards of order 6 and up are written with numbers only
+MAX_LETTER_VALUE = 35
+# POPCOUNT[mask] is the number of values in the domain represented by mask, for boards up to 16x16
+POPCOUNT = [bin(mask).count("1") for mask in range(1 << 16)]
+
+
+def popcount(mask):
+    return bin(mask).count("1")
+
+
+def luby(i):
+    """
+    Returns the i-th term (from 1) of the Luby sequence 1, 1, 2, 1, 1, 2, 4, 1, 1, 2, ...
+    """
+    k = 1
+    while (1 << k) - 1 < i:
+        k += 1
+    if i == (1 << k) - 1:
+        return 1 << (k - 1)
+    # Otherwise i is in the repeat of the sequence so far that starts the k-th block
+    return luby(i - (1 << (k - 1)) + 1)
+
+
+class NodeLimitReached(Exception):
+    """
+    Raised by the search when it has used up the node limit of the current restart
+    """
+    pass
+
+
+class ConstraintGraph(object):
+    """
+    Constraints of a puzzle of a given order, built once and shared by every Sudoku of that
+    order. Cells are numbered row * size + col. Use get_constraint_graph instead of creating
+    one directly.
+
+    units: cells of each row, then each column, then each box
+    cell_units: (row, col, box) unit numbers of each cell
+    peers: cells sharing a unit with each cell
+    arc_successors: arc_successors[x * num_cells + y] are the peers of x excluding y, i.e. the
+    arcs (z, x) to queue after revising the arc (x, y). None if y is not a peer of x
+    neighbours: peers of each (row, col) variable as (row, col) tuples
+    neighbour_arcs: peers of x excluding y for each pair of neighbouring (row, col) variables
+    arc_successors and neighbour_arcs are None until get_arc_successors or get_neighbour_arcs
+    first builds them, since only CSP inference uses them and they grow with num_cells ** 2
+    intersections: (segment, box_rest, line_rest) for each box and each row or col crossing it,
+    where segment is the cells in both, box_rest the other cells of the box and line_rest the
+    other cells of the row or col
+    dlx_*: links of the Dancing Links matrix before any column is covered
+    """
+
+    def __init__(self, order):
+        self.order = order
+        self.size = size = order * order
+        self.num_cells = num_cells = size * size
+
+        rows = [tuple(row * size + col for col in range(size)) for row in range(size)]
+        cols = [tuple(row * size + col for row in range(size)) for col in range(size)]
+        boxes = []
+        for box in range(size):
+            box_row = (box // order) * order
+            box_col = (box % order) * order
+            boxes.append(tuple(row * size + col
+                               for row in range(box_row, box_row + order)
+                               for col in range(box_col, box_col + order)))
+        self.units = tuple(rows + cols + boxes)
+        self.cell_units = tuple((cell // size, size + cell % size,
+                                 2 * size + (cell // size // order) * order + cell % size // order)
+                                for cell in range(num_cells))
+
+        peers = []
+        for cell in range(num_cells):
+            row, col = divmod(cell, size)
+            cell_peers = []
+            # Neighbours in row and col
+            for i in range(size):
+                if i != col:
+                    cell_peers.append(row * size + i)
+                if i != row:
+                    cell_peers.append(i * size + col)
+            # Neighbours in box, not in the same row or col to prevent double counting
+            for peer in self.units[self.cell_units[cell][2]]:
+                if peer // size != row and peer % size != col:
+                    cell_peers.append(peer)
+            peers.append(tuple(cell_peers))
+        self.peers = tuple(peers)
+
+        self.neighbours = {}
+        for x in range(num_cells):
+            self.neighbours[divmod(x, size)] = tuple(divmod(y, size) for y in self.peers[x])
+        self.arc_successors = None
+        self.neighbour_arcs = None
+
+        intersections = []
+        for box in boxes:
+            box_cells = set(box)
+            for line in rows + cols:
+                segment = box_cells.intersection(line)
+                if segment:
+                    intersections.append((tuple(sorted(segment)),
+                                          tuple(cell for cell in box if cell not in segment),
+                                          tuple(cell for cell in line if cell not in segment)))
+        self.intersections = tuple(intersections)
+
+        self.build_dlx_template()
+
+    def get_arc_successors(self):
+        if self.arc_successors is None:
+            self.build_arc_tables()
+        return self.arc_successors
+
+    def get_neighbour_arcs(self):
+        if self.neighbour_arcs is None:
+            self.build_arc_tables()
+        return self.neighbour_arcs
+
+    def build_arc_tables(self):
+        size, num_cells = self.size, self.num_cells
+        arc_successors = [None] * (num_cells * num_cells)
+        for x in range(num_cells):
+            for y in self.peers[x]:
+                arc_successors[x * num_cells + y] = tuple(z for z in self.peers[x] if z != y)
+        self.arc_successors = tuple(arc_successors)
+
+        self.neighbour_arcs = {}
+        for x in range(num_cells):
+            var = divmod(x, size)
+            for y in self.peers[x]:
+                self.neighbour_arcs[(var, divmod(y, size))] = tuple(
+                    divmod(z, size) for z in arc_successors[x * num_cells + y])
+
+    def build_dlx_template(self):
+        size, order, num_cells = self.size, self.order, self.num_cells
+        num_columns = 4 * num_cells
+        left = [i - 1 for i in range(num_columns + 1)]
+        right = [i + 1 for i in range(num_columns + 1)]
+        left[0] = num_columns
+        right[num_columns] = 0
+        up = list(range(num_columns + 1))
+        down = list(range(num_columns + 1))
+        columns = list(range(num_columns + 1))
+        sizes = [0] * (num_columns + 1)
+        candidates = [-1] * (num_columns + 1)
+        # First node of each candidate row, indexed by cell * size + value - 1
+        row_nodes = []
+
+        for cell in range(num_cells):
+            row, col = divmod(cell, size)
+            box = (row // order) * order + col // order
+            for value_index in range(size):
+                candidate_columns = (1 + cell,
+                                     1 + num_cells + row * size + value_index,
+                                     1 + 2 * num_cells + col * size + value_index,
+                                     1 + 3 * num_cells + box * size + value_index)
+                first = len(left)
+                row_nodes.append(first)
+                for k in range(4):
+                    column = candidate_columns[k]
+                    node = first + k
+                    left.append(first + (k - 1) % 4)
+                    right.append(first + (k + 1) % 4)
+                    # Append node to the bottom of its column
+                    up.append(up[column])
+                    down.append(column)
+                    down[up[column]] = node
+                    up[column] = node
+                    columns.append(column)
+                    candidates.append(cell * size + value_index)
+                    sizes[column] += 1
+
+        self.dlx_left = tuple(left)
+        self.dlx_right = tuple(right)
+        self.dlx_up = tuple(up)
+        self.dlx_down = tuple(down)
+        self.dlx_column = tuple(columns)
+        self.dlx_size = tuple(sizes)
+        self.dlx_candidate = tuple(candidates)
+        self.dlx_row_nodes = tuple(row_nodes)
+
+
+# Constraint graphs by order, shared by all Sudoku instances in this process
+CONSTRAINT_GRAPHS = {}
+
+
+def get_constraint_graph(order):
+    if order not in CONSTRAINT_GRAPHS:
+        CONSTRAINT_GRAPHS[order] = ConstraintGraph(order)
+    return CONSTRAINT_GRAPHS[order]
+
+
+# Build the graph for 9x9 puzzles at import so that batch workers start with it
+get_constraint_graph(3)
+
+
+# Symmetry transforms by order, see get_symmetry_transforms
+SYMMETRY_TRANSFORMS = {}
+
+
+def get_symmetry_transforms(order):
+    """
+    Returns the transforms made of an optional transpose, a permutation of the bands and a
+    permutation of the stacks, each as a tuple giving the source cell of every cell
+    """
+    if order not in SYMMETRY_TRANSFORMS:
+        size = order * order
+        line_orders = [[block * order + i for block in blocks for i in range(order)]
+                       for blocks in permutations(range(order))]
+        transforms = []
+        for rows in line_orders:
+            for cols in line_orders:
+                transforms.append(tuple(rows[r] * size + cols[c] for r in range(size) for c in range(size)))
+                transforms.append(tuple(cols[c] * size + rows[r] for r in range(size) for c in range(size)))
+        SYMMETRY_TRANSFORMS[order] = tuple(transforms)
+    return SYMMETRY_TRANSFORMS[order]
+
+
+def canonical_form(cells, order):
+    """
+    Returns (key, transform, labels) for the flat tuple of cell values of a puzzle. key is the
+    smallest tuple over all symmetry transforms of the transformed cells with values relabelled
+    in order of first appearance, so every relabelling, transpose and band or stack permutation
+    of a puzzle has the same key. key[i] == labels[cells[transform[i]]]
+    """
+    size = order * order
+    best = None
+    for transform in get_symmetry_transforms(order):
+        labels = [0] * (size + 1)
+        next_label = 1
+        key = []
+        smaller = best is None
+        for i in transform:
+            value = cells[i]
+            if value and not labels[value]:
+                labels[value] = next_label
+                next_label += 1
+            label = labels[value]
+            if not smaller:
+                best_label = best[0][len(key)]
+                if label > best_label:
+                    break
+                smaller = label < best_label
+            key.append(label)
+        else:
+            if smaller:
+                best = (key, transform, labels)
+
+    key, transform, labels = best
+    # Values missing from the puzzle take the remaining labels, so that labels is a bijection
+    next_label = max(labels) + 1
+    for value in range(1, size + 1):
+        if not labels[value]:
+            labels[value] = next_label
+            next_label += 1
+    return tuple(key), transform, labels
+
+
+class SolutionCache(object):
+    """
+    Size-bounded LRU cache of solutions keyed by the canonical form of their puzzle, so that a
+    puzzle is found if any of its relabellings, transposes or band and stack permutations was
+    solved before. Entries are kept in memory and written to path by save(), one
+    'canonical_puzzle canonical_solution' line per entry, least recently used first
+    """
+
+    def __init__(self, path, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        self.entries[fields[0]] = fields[1]
+        self.evict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, canonical, order):
+        """
+        Returns the solution of the puzzle with the given canonical_form as a flat list of
+        cell values, or None if it is not cached
+        """
+        key, transform, labels = canonical
+        key = self.format_cells(key, order)
+        if key not in self.entries:
+            return None
+        # Re-inserting moves the entry to the most recently used end
+        line = self.entries.pop(key)
+        self.entries[key] = line
+        values = [0] * (len(labels))
+        for value in range(1, len(labels)):
+            values[labels[value]] = value
+        cells = line.split(",") if "," in line else line
+        solution = [0] * len(transform)
+        for i in range(len(transform)):
+            solution[transform[i]] = values[parse_value(cells[i])]
+        return solution
+
+    def put(self, canonical, solution, order):
+        """
+        Stores the flat list of cell values solution of the puzzle with the given canonical_form
+        """
+        key, transform, labels = canonical
+        self.entries[self.format_cells(key, order)] = self.format_cells(
+            [labels[solution[i]] for i in transform], order)
+        self.evict()
+
+    def evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def format_cells(self, cells, order):
+        # Entries are single tokens on a line, so the cells of boards written with spaces are
+        # separated by commas instead
+        return format_line(cells, order, False).replace(" ", ",")
+
+    def save(self):
+        """
+        Writes the entries to a temporary file that then replaces path, so that an interrupted
+        save leaves the old cache intact
+        """
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as f:
+            for key, line in self.entries.items():
+                f.write(key + " " + line + "\n")
+        if hasattr(os, "replace"):
+            os.replace(temp_path, self.path)
+        else:
+            # Python 2: rename replaces the target atomically on POSIX
+            os.rename(temp_path, self.path)
+
+
+class DomainBuckets(object):
+    """
+    Bucket queue of the unassigned variables, keyed by domain size and then by number of
+    unassigned neighbours, so that the most constrained variable (with most constraining
+    variable as tie break) is found without scanning every variable. Variables may be
+    (row, col) tuples or cell numbers, as long as neighbours is indexed by them.
+    """
+
+    def __init__(self, variables, neighbours, domain_sizes, max_domain_size):
+        """
+        domain_sizes maps each unassigned variable to the size of its domain
+        """
+        self.neighbours = neighbours
+        max_degree = max(len(neighbours[var]) for var in variables)
+        self.buckets = [[set() for degree in range(max_degree + 1)] for size in range(max_domain_size + 1)]
+        # Number of variables in each row of buckets
+        self.size_counts = [0] * (max_domain_size + 1)
+        # Domain size of each unassigned variable
+        self.domain_size = {}
+        # Number of unassigned neighbours of every variable, assigned or not
+        self.degree = {}
+        for var in variables:
+            self.degree[var] = sum(1 for neighbour in neighbours[var] if neighbour in domain_sizes)
+        for var in domain_sizes:
+            self.insert(var, domain_sizes[var])
+
+    def __len__(self):
+        return len(self.domain_size)
+
+    def insert(self, var, domain_size):
+        self.domain_size[var] = domain_size
+        self.buckets[domain_size][self.degree[var]].add(var)
+        self.size_counts[domain_size] += 1
+
+    def assign(self, var):
+        """
+        Removes var from the queue and decrements the degree of its neighbours
+        """
+        domain_size = self.domain_size.pop(var)
+        self.buckets[domain_size][self.degree[var]].remove(var)
+        self.size_counts[domain_size] -= 1
+        for neighbour in self.neighbours[var]:
+            degree = self.degree[neighbour]
+            self.degree[neighbour] = degree - 1
+            if neighbour in self.domain_size:
+                row = self.buckets[self.domain_size[neighbour]]
+                row[degree].remove(neighbour)
+                row[degree - 1].add(neighbour)
+
+    def unassign(self, var, domain_size):
+        """
+        Puts var back in the queue with the given domain size and increments the degree of
+        its neighbours
+        """
+        for neighbour in self.neighbours[var]:
+            degree = self.degree[neighbour]
+            self.degree[neighbour] = degree + 1
+            if neighbour in self.domain_size:
+                row = self.buckets[self.domain_size[neighbour]]
+                row[degree].remove(neighbour)
+                row[degree + 1].add(neighbour)
+        self.insert(var, domain_size)
+
+    def resize(self, var, domain_size):
+        """
+        Moves var to the bucket of its new domain size. Assigned variables are ignored
+        """
+        old_domain_size = self.domain_size.get(var)
+        if old_domain_size is None or old_domain_size == domain_size:
+            return
+        degree = self.degree[var]
+        self.buckets[old_domain_size][degree].remove(var)
+        self.buckets[domain_size][degree].add(var)
+        self.size_counts[old_domain_size] -= 1
+        self.size_counts[domain_size] += 1
+        self.domain_size[var] = domain_size
+
+    def most_constrained(self):
+        for domain_size, count in enumerate(self.size_counts):
+            if count:
+                row = self.buckets[domain_size]
+                for degree in range(len(row) - 1, -1, -1):
+                    if row[degree]:
+                        return next(iter(row[degree]))
+        return None
 
 
 class Sudoku(object):
     """
     DATA STRUCTURES USED IN THIS SOLVER
 
+    order: size of each box, i.e. the puzzle has order ** 2 rows, columns, boxes and values
     state: 2D array that represents the current state of the puzzle
     domain: 2D array of lists, each list representing the domain of each
     variable. If the variable is assigned, then the domain value will be 0
@@ -25,38 +505,136 @@ class Sudoku(object):
     # Variable heuristics
     FIRST_UNASSIGNED_VAR = 0
     MOST_CONSTRAINED_VAR = 1
+    MOST_CONSTRAINED_VAR_BUCKETS = 2
+    DOM_WDEG = 3
 
     # Value heuristics
     RANDOM_SHUFFLE = 0
     LEAST_CONSTRAINING_VAL = 1
+    LEAST_CONSTRAINING_VAL_COUNTS = 2
 
     # Inference heuristics
     FORWARD_CHECKING = 0
     AC3 = 1
-
-    def __init__(self, puzzle):
+    AC3_INCREMENTAL = 2
+    RULE_PROPAGATION = 3
+    ALL_DIFFERENT_GAC = 4
+    AC3_RESIDUAL = 5
+
+    # Domain representations
+    SET_DOMAINS = 0
+    BITMASK_DOMAINS = 1
+
+    # Solve engines
+    CSP_ENGINE = 0
+    DLX_ENGINE = 1
+
+    # Search algorithms
+    CHRONOLOGICAL_BACKTRACKING = 0
+    CONFLICT_DIRECTED_BACKJUMPING = 1
+    ITERATIVE_BACKTRACKING = 2
+
+    # Restart schedules
+    NO_RESTARTS = 0
+    LUBY_RESTARTS = 1
+    GEOMETRIC_RESTARTS = 2
+
+    def __init__(self, puzzle, order=3):
         # you may add more attributes if you need
         self.puzzle = puzzle  # self.puzzle is a list of lists
+        self.order = order
+        self.size = order * order
+        self.num_cells = self.size * self.size
+        self.all_values_mask = (1 << self.size) - 1
+        if self.size <= 16:
+            self.popcount = POPCOUNT.__getitem__
+        else:
+            self.popcount = popcount
         self.variable_heuristic = self.MOST_CONSTRAINED_VAR
         self.value_heuristic = self.LEAST_CONSTRAINING_VAL
-        self.inference_heuristic = self.AC3
-        self.neighbours_dict = {}
+        self.inference_heuristic = self.AC3_INCREMENTAL
+        self.domain_representation = self.SET_DOMAINS
+        self.solve_engine = self.DLX_ENGINE
+        self.search_algorithm = self.CHRONOLOGICAL_BACKTRACKING
+        self.restart_schedule = self.NO_RESTARTS
+        # Nodes allowed in the first restart, scaled by the Luby term or the geometric factor
+        self.restart_base = 100
+        self.restart_factor = 1.5
+        # Breaks ties in the variable and value heuristics randomly instead of by position
+        self.random_tie_breaking = False
+        # Seed of rng, used for RANDOM_SHUFFLE and random tie breaking. None seeds from the OS
+        self.seed = None
+        self.rng = random.Random()
+        self.node_limit = None
+        self.restarts = 0
+        # Iterative search state, kept on self so that resume_search can carry on after a pause.
+        # search_stack holds a [var, values, index of the next value to try] frame per level
+        self.search_slice = None
+        self.search_domains = None
+        self.search_stack = []
+        self.search_descend = False
+        self.search_paused = False
+        # The DLX search stops at the solution_limit-th solution, None to find all of them
+        self.solution_limit = 1
+        self.solutions_found = 0
+        # Masks ANDed into the initial masks of the bitmask search, e.g. the pruned domains of a
+        # subproblem of the parallel search
+        self.initial_masks = None
+        self.graph = get_constraint_graph(order)
+        self.neighbours_dict = self.graph.neighbours
+        self.peers = self.graph.peers
         self.count = 0
+        # Undo trail: flat log of (variable, removed value) pairs, or (cell, removed bits) pairs
+        # for bitmask domains, with the trail index at each search node kept in trail_marks
+        self.trail = []
+        self.trail_top = 0
+        self.trail_marks = []
+        # DomainBuckets of the unassigned variables, only kept for MOST_CONSTRAINED_VAR_BUCKETS
+        self.buckets = None
+        # unit_value_counts[unit * (size + 1) + value] is the number of cells in unit with value
+        # in their domain, only kept for LEAST_CONSTRAINING_VAL_COUNTS
+        self.unit_value_counts = None
+        # unit_matchings[unit][i] is the value index matched to unit[i], kept between calls to
+        # all_different_gac since a matching stays mostly valid as domains shrink
+        self.unit_matchings = None
+        # residues[(x, y)][value] is the last value of y found to support value of x on the arc
+        # x != y, or 0, only kept for AC3_RESIDUAL. Kept between calls to ac3 since a support
+        # that is still in the domain of y needs no search
+        self.residues = {}
+        # Number of value pairs or masks compared by the revise methods of the AC3 heuristics, and
+        # number of values of x that revise_residual found supported by their residue instead
+        self.support_checks = 0
+        self.residue_hits = 0
+        # unit_weights[unit] is 1 plus the number of domain wipe-outs caused by the unit, only
+        # kept for DOM_WDEG. Kept between solves of the same Sudoku
+        self.unit_weights = None
+        # Conflict directed backjumping state, only kept for CONFLICT_DIRECTED_BACKJUMPING. Sets
+        # of search levels are bitmasks with bit d set for the assignment made at depth d.
+        # conflict_sets: levels whose assignments removed values from each cell
+        # trail_conflicts: conflict set of the cell before each trail entry, to undo with it
+        # cell_levels: depth each cell was assigned at, or -1
+        # level_literals: cell * size + value - 1 assigned at each depth
+        # nogoods: literal -> tuples of the other literals of each nogood containing it
+        self.conflict_sets = None
+        self.trail_conflicts = None
+        self.cell_levels = None
+        self.level_literals = None
+        self.nogoods = {}
+        self.nogood_set = set()
+        self.depth = -1
+        self.failure_conflicts = None
+        self.jump_conflicts = 0
 
     def solve(self):
         start = time.time()
-        # Build dictionary of neighbours for each variable
-        for row in range(9):
-            for col in range(9):
-                var = (row, col)
-                self.neighbours_dict[var] = self.get_unassigned_neighbours(var, [], get_all_neighbours=True)
-
-        # Build initial domains
-        domains = self.get_initial_fc_domains(self.puzzle)
-
-        # self.print_domains(self.puzzle, domains)
-        ans = self.run_back_tracking(self.puzzle, domains)
+        ans = self.find_solution()
         print("Backtrack called {0} times".format(self.count))
+        # The DLX engine does no inference, so it has no support checks to report
+        if self.solve_engine == self.CSP_ENGINE:
+            if self.inference_heuristic in (self.AC3, self.AC3_INCREMENTAL, self.AC3_RESIDUAL):
+                print("Support checks: {0}".format(self.support_checks))
+            if self.inference_heuristic == self.AC3_RESIDUAL:
+                print("Supports found from residues: {0}".format(self.residue_hits))
 
         if ans is None:
             return "Did not solve :("
@@ -66,8 +644,215 @@ class Sudoku(object):
 
         return ans
 
+    def find_solution(self):
+        """
+        Returns the solved state, or None if the puzzle has no solution
+        """
+        if (self.inference_heuristic in (self.RULE_PROPAGATION, self.ALL_DIFFERENT_GAC)
+                and self.domain_representation != self.BITMASK_DOMAINS):
+            raise ValueError("This inference heuristic requires BITMASK_DOMAINS!")
+        if (self.search_algorithm == self.CONFLICT_DIRECTED_BACKJUMPING
+                and self.domain_representation != self.BITMASK_DOMAINS):
+            raise ValueError("Conflict directed backjumping requires BITMASK_DOMAINS!")
+
+        if self.variable_heuristic == self.DOM_WDEG and self.unit_weights is None:
+            self.unit_weights = [1] * len(self.graph.units)
+        self.rng.seed(self.seed)
+
+        if self.restart_schedule == self.NO_RESTARTS or self.solve_engine == self.DLX_ENGINE:
+            return self.run_search()
+        return self.run_restarts()
+
+    def run_restarts(self):
+        """
+        Runs the search with a growing node limit until it finishes within the limit. Unit
+        weights and nogoods are kept on self, so each restart starts with what the last learned
+        """
+        givens = [row[:] for row in self.puzzle]
+        i = 0
+        while True:
+            i += 1
+            if self.restart_schedule == self.LUBY_RESTARTS:
+                limit = self.restart_base * luby(i)
+            else:
+                limit = int(self.restart_base * self.restart_factor ** (i - 1))
+            self.node_limit = self.count + limit
+            try:
+                ans = self.run_search()
+                self.node_limit = None
+                return ans
+            except NodeLimitReached:
+                self.restarts += 1
+                for row, given_row in zip(self.puzzle, givens):
+                    row[:] = given_row
+
+    def run_search(self):
+        """
+        Runs the selected engine once from the givens in self.puzzle
+        """
+        self.reset_trail()
+
+        if self.solve_engine == self.DLX_ENGINE:
+            ans = self.solve_dlx()
+        elif self.domain_representation == self.BITMASK_DOMAINS:
+            ans = self.solve_bitmask()
+        else:
+            # Build initial domains
+            domains = self.get_initial_fc_domains(self.puzzle)
+            if domains is None:
+                return None
+            if self.variable_heuristic == self.MOST_CONSTRAINED_VAR_BUCKETS:
+                domain_sizes = {}
+                for var in self.get_unassigned_variables(self.puzzle):
+                    domain_sizes[var] = len(domains[var])
+                self.buckets = DomainBuckets(domains.keys(), self.neighbours_dict, domain_sizes, self.size)
+            if self.value_heuristic == self.LEAST_CONSTRAINING_VAL_COUNTS:
+                self.unit_value_counts = [0] * (3 * self.size * (self.size + 1))
+                for row, col in domains:
+                    for value in domains[(row, col)]:
+                        self.update_unit_value_counts(row * self.size + col, value, 1)
+
+            # self.print_domains(self.puzzle, domains)
+            if self.search_algorithm == self.ITERATIVE_BACKTRACKING:
+                self.start_iterative_search(domains)
+                ans = self.resume_search(self.search_slice)
+            else:
+                ans = self.run_back_tracking(self.puzzle, domains)
+        return ans
+
+    def reset_trail(self):
+        # Every value is removed at most once along a search path, so num_cells * size entries suffice
+        self.trail = [0] * (2 * self.num_cells * self.size)
+        self.trail_top = 0
+        self.trail_marks = []
+
+    def count_solutions(self, limit=None):
+        """
+        Returns the number of solutions of the puzzle, stopping the search as soon as limit of
+        them are found. The DLX engine counts within its search, the CSP engine resumes the
+        iterative search after each solution. self.puzzle is left as given
+        """
+        givens = [row[:] for row in self.puzzle]
+        if self.solve_engine == self.DLX_ENGINE:
+            self.solution_limit = limit
+            self.find_solution()
+            self.solution_limit = 1
+            count = self.solutions_found
+        else:
+            settings = (self.search_algorithm, self.restart_schedule, self.search_slice)
+            self.search_algorithm = self.ITERATIVE_BACKTRACKING
+            self.restart_schedule = self.NO_RESTARTS
+            self.search_slice = None
+            count = 0
+            state = self.find_solution()
+            while state is not None:
+                count += 1
+                if limit is not None and count >= limit:
+                    break
+                state = self.resume_search()
+            self.search_algorithm, self.restart_schedule, self.search_slice = settings
+
+        for row, given_row in zip(self.puzzle, givens):
+            row[:] = given_row
+        return count
+
+    def is_unique(self):
+        """
+        Returns True if the puzzle has exactly one solution, searching no further than a second one
+        """
+        return self.count_solutions(2) == 1
+
+    def start_iterative_search(self, domains):
+        """
+        Sets up resume_search to search from self.puzzle with domains, which are sets or masks
+        depending on the domain representation
+        """
+        self.search_domains = domains
+        self.search_stack = []
+        self.search_descend = True
+        self.search_paused = False
+
+    def resume_search(self, max_nodes=None):
+        """
+        Runs the iterative search for at most max_nodes more nodes. Returns the solved state, or
+        None if there is no solution or the search paused, in which case search_paused is set
+        and the next call carries on where this one stopped. Visits the same nodes in the same
+        order as run_back_tracking and run_back_tracking_bitmask, without recursion
+        """
+        state = self.puzzle
+        domains = self.search_domains
+        stack = self.search_stack
+        bitmask = self.domain_representation == self.BITMASK_DOMAINS
+        stop_count = None
+        if max_nodes is not None:
+            stop_count = self.count + max_nodes
+        self.search_paused = False
+
+        while True:
+            if self.search_descend:
+                if stop_count is not None and self.count >= stop_count:
+                    self.search_paused = True
+                    return None
+                self.count += 1
+                if self.node_limit is not None and self.count > self.node_limit:
+                    raise NodeLimitReached()
+                if self.is_goal_state(state):
+                    # Resuming after a solution backtracks from it
+                    self.search_descend = False
+                    return state
+                if bitmask:
+                    var = self.select_unassigned_cell(state, domains)
+                    values = self.order_mask_values(domains, var)
+                else:
+                    var = self.select_unassigned_variable(state, domains)
+                    values = self.order_domain_values(domains, var)
+                stack.append([var, values, 0])
+                self.search_descend = False
+
+            if len(stack) == 0:
+                return None
+            frame = stack[-1]
+            var, values, index = frame
+            if bitmask:
+                var_row, var_col = divmod(var, self.size)
+            else:
+                var_row, var_col = var
+
+            # Undo the value tried last, if any
+            if state[var_row][var_col] != 0:
+                if bitmask:
+                    self.restore_masks(domains)
+                    domain_size = self.popcount(domains[var])
+                else:
+                    self.restore_domains(domains)
+                    domain_size = len(domains[var])
+                if self.buckets is not None:
+                    self.buckets.unassign(var, domain_size)
+                state[var_row][var_col] = 0
+
+            if index == len(values):
+                stack.pop()
+                continue
+            frame[2] = index + 1
+            value = values[index]
+
+            state[var_row][var_col] = value
+            if self.buckets is not None:
+                self.buckets.assign(var)
+            self.push_trail_mark()
+            if bitmask:
+                self.remove_bits(domains, var, domains[var] & ~(1 << (value - 1)))
+                self.search_descend = self.inference_bitmask(state, domains, var, value) is not None
+            else:
+                for other_value in values:
+                    if other_value != value:
+                        self.remove_value(domains, var, other_value)
+                self.search_descend = self.inference(state, domains, var, value) is not None
+
     def run_back_tracking(self, state, domains):
         self.count += 1
+        if self.node_limit is not None and self.count > self.node_limit:
+            raise NodeLimitReached()
         # self.print_domains(state, domains)
         if self.is_goal_state(state):
             return state
@@ -84,21 +869,27 @@ class Sudoku(object):
         for value in sorted_domain:
             # print("Value: {}".format(value))
             state[var_row][var_col] = value
-            # values_removed contains the values that were removed from each variable's domains during inference
-            # Original domains is retrieved by taking the union of this set and the modified domains
-            values_removed = {var: set(domains[var])}
-            domains[var] = set([value])
+            if self.buckets is not None:
+                self.buckets.assign(var)
+            # Every value removed from here on is logged to the trail and undone by popping
+            # back to this mark
+            self.push_trail_mark()
+            for other_value in sorted_domain:
+                if other_value != value:
+                    self.remove_value(domains, var, other_value)
 
             # INFERENCE HEURISTIC HERE
             # self.inference directly modifies domains
-            if self.inference(state, domains, var, value, values_removed) is not None:
+            if self.inference(state, domains, var, value) is not None:
                 result = self.run_back_tracking(state, domains)
 
                 if result is not None:
                     return result
 
             # Restore original domains
-            self.restore_domains(domains, values_removed)
+            self.restore_domains(domains)
+            if self.buckets is not None:
+                self.buckets.unassign(var, len(domains[var]))
 
             state[var_row][var_col] = 0
 
@@ -107,60 +898,47 @@ class Sudoku(object):
     """
     UTILITY FUNCTIONS
     """
-    def restore_domains(self, domains, values_removed):
-        for key in values_removed:
-            # Union of sets to restore the original domain
-            domains[key] |= values_removed[key]
-
-    def get_unassigned_neighbours(self, var, state, get_all_neighbours=False):
+    def push_trail_mark(self):
+        self.trail_marks.append(self.trail_top)
+
+    def remove_value(self, domains, var, value):
+        domains[var].remove(value)
+        top = self.trail_top
+        self.trail[top] = var
+        self.trail[top + 1] = value
+        self.trail_top = top + 2
+        if self.buckets is not None:
+            self.buckets.resize(var, len(domains[var]))
+        if self.unit_value_counts is not None:
+            self.update_unit_value_counts(var[self.ROW] * self.size + var[self.COL], value, -1)
+
+    def restore_domains(self, domains):
         """
-        Returns a list of neighbours or all unassigned neighbours of var
+        Adds back every value removed since the last trail mark and pops the mark
         """
-        neighbours = []
-        row, col = var
-
-        if get_all_neighbours:
-            # Neighbours in row and col
-            for i in range(9):
-                if i != col:
-                    neighbours.append((row, i))
-                if i != row:
-                    neighbours.append((i, col))
-
-            # Neighbours in box
-            box_row = (row // 3) * 3
-            box_col = (col // 3) * 3
-
-            for i in range(box_row, box_row + 3):
-                for j in range(box_col, box_col + 3):
-                    # Not same row AND not same col to prevent double counting from above
-                    if i != row and j != col:
-                        neighbours.append((i, j))
-
-        else:
-            # Neighbours in row and col
-            for i in range(9):
-                if state[row][i] == 0 and i != col:
-                    neighbours.append((row, i))
-                if state[i][col] == 0 and i != row:
-                    neighbours.append((i, col))
-
-            # Neighbours in box
-            box_row = (row // 3) * 3
-            box_col = (col // 3) * 3
-
-            for i in range(box_row, box_row + 3):
-                for j in range(box_col, box_col + 3):
-                    # Not same row AND not same col to prevent double counting from above
-                    if state[i][j] == 0 and (i != row and j != col):
-                        neighbours.append((i, j))
-
-        return neighbours
+        mark = self.trail_marks.pop()
+        trail = self.trail
+        top = self.trail_top
+        while top > mark:
+            top -= 2
+            var = trail[top]
+            domains[var].add(trail[top + 1])
+            if self.buckets is not None:
+                self.buckets.resize(var, len(domains[var]))
+            if self.unit_value_counts is not None:
+                self.update_unit_value_counts(var[self.ROW] * self.size + var[self.COL], trail[top + 1], 1)
+        self.trail_top = mark
+
+    def update_unit_value_counts(self, cell, value, delta):
+        counts = self.unit_value_counts
+        stride = self.size + 1
+        for unit in self.graph.cell_units[cell]:
+            counts[unit * stride + value] += delta
 
     def get_unassigned_variables(self, state):
         unassigned_variables = []
-        for row in range(9):
-            for col in range(9):
+        for row in range(self.size):
+            for col in range(self.size):
                 if state[row][col] == 0:
                     unassigned_variables.append((row, col))
         return unassigned_variables
@@ -170,8 +948,10 @@ class Sudoku(object):
         Simple check to see if all variables are assigned. If a variable has
         value 0, then there are still unassigned variables.
         """
-        for row in range(9):
-            for col in range(9):
+        if self.buckets is not None:
+            return len(self.buckets) == 0
+        for row in range(self.size):
+            for col in range(self.size):
                 if state[row][col] == 0:
                     return False
         return True
@@ -179,17 +959,18 @@ class Sudoku(object):
     def is_legal_assignment(self, value, var, state):
         row, col = var
         # check row and col constraints
-        for i in range(9):
+        for i in range(self.size):
             # Note: variable is not yet assigned during this function call
             if state[row][i] == value or state[i][col] == value:
                 return False
 
         # check box constraints
-        box_row = (row // 3) * 3
-        box_col = (col // 3) * 3
+        order = self.order
+        box_row = (row // order) * order
+        box_col = (col // order) * order
 
-        for row in range(box_row, box_row + 3):
-            for col in range(box_col, box_col + 3):
+        for row in range(box_row, box_row + order):
+            for col in range(box_col, box_col + order):
                 if value == state[row][col]:
                     return False
 
@@ -197,22 +978,23 @@ class Sudoku(object):
 
     def get_initial_domains(self, state):
         initial_domains = {}
-        for row in range(9):
-            for col in range(9):
+        for row in range(self.size):
+            for col in range(self.size):
                 if state[row][col] != 0:
                     initial_domains[(row, col)] = set([state[row][col]])
                 else:
-                    initial_domains[(row, col)] = set([1, 2, 3, 4, 5, 6, 7, 8, 9])
+                    initial_domains[(row, col)] = set(range(1, self.size + 1))
         return initial_domains
 
     def get_initial_fc_domains(self, state):
         initial_domains = self.get_initial_domains(state)
-        for row in range(9):
-            for col in range(9):
+        for row in range(self.size):
+            for col in range(self.size):
                 var = (row, col)
                 val = state[row][col]
                 if val != 0:
-                    self.forward_checking(state, initial_domains, var, val, {})
+                    if self.forward_checking(state, initial_domains, var, val) is None:
+                        return None
         return initial_domains
 
     """
@@ -222,18 +1004,24 @@ class Sudoku(object):
         """
         FIRST_UNASSIGNED_VAR returns the first unassigned variable
         MOST_CONSTRAINED_VAR returns the most constrained variable
+        MOST_CONSTRAINED_VAR_BUCKETS returns the most constrained variable from the bucket queue
         """
         if self.variable_heuristic == self.FIRST_UNASSIGNED_VAR:
             return self.first_unassigned(state)
         elif self.variable_heuristic == self.MOST_CONSTRAINED_VAR:
             return self.most_constrained_variable(state, domains)
+        elif self.variable_heuristic == self.MOST_CONSTRAINED_VAR_BUCKETS:
+            return self.buckets.most_constrained()
+        elif self.variable_heuristic == self.DOM_WDEG:
+            return divmod(self.dom_wdeg_cell(state, lambda cell: len(domains[divmod(cell, self.size)])),
+                          self.size)
 
     def first_unassigned(self, state):
         """
         Returns first unassigned variable
         """
-        for row in range(9):
-            for col in range(9):
+        for row in range(self.size):
+            for col in range(self.size):
                 if state[row][col] == 0:
                     return (row, col)
 
@@ -243,9 +1031,9 @@ class Sudoku(object):
         as tie break
         """
         results = []
-        min_domain_length = 10
-        for row in range(9):
-            for col in range(9):
+        min_domain_length = self.size + 1
+        for row in range(self.size):
+            for col in range(self.size):
                 domain = domains[(row, col)]
                 if state[row][col] == 0:
                     if len(domain) < min_domain_length:
@@ -268,8 +1056,52 @@ class Sudoku(object):
             if constraints > max_constraints:
                 max_constraints = constraints
                 result = var
+                ties = 1
+            elif constraints == max_constraints and self.random_tie_breaking:
+                # Reservoir sampling keeps each tied variable with equal probability
+                ties += 1
+                if self.rng.randrange(ties) == 0:
+                    result = var
         return result
 
+    def dom_wdeg_cell(self, state, domain_length):
+        """
+        Returns the unassigned cell with the smallest domain length divided by the total weight
+        of its units. domain_length maps a cell to the size of its domain
+        """
+        size = self.size
+        weights = self.unit_weights
+        cell_units = self.graph.cell_units
+        result = None
+        best_length = 1
+        best_weight = 0
+        for cell in range(self.num_cells):
+            if state[cell // size][cell % size] == 0:
+                row_unit, col_unit, box_unit = cell_units[cell]
+                weight = weights[row_unit] + weights[col_unit] + weights[box_unit]
+                length = domain_length(cell)
+                # length / weight < best_length / best_weight without division
+                if length * best_weight < best_length * weight:
+                    result = cell
+                    best_length = length
+                    best_weight = weight
+                    ties = 1
+                elif length * best_weight == best_length * weight and self.random_tie_breaking:
+                    ties += 1
+                    if self.rng.randrange(ties) == 0:
+                        result = cell
+        return result
+
+    def bump_constraint_weights(self, x, y):
+        """
+        Increases the weight of the units shared by cells x and y, after the constraint between
+        them wiped out a domain
+        """
+        y_units = self.graph.cell_units[y]
+        for unit in self.graph.cell_units[x]:
+            if unit in y_units:
+                self.unit_weights[unit] += 1
+
     """
     Value Heuristics
     """
@@ -278,11 +1110,14 @@ class Sudoku(object):
         For now just randomly sort the domain
         """
         if self.value_heuristic == self.RANDOM_SHUFFLE:
-            new_domain = domains[var]
-            random.shuffle(list(new_domain))
+            # Domains are modified in place during the search, so return a copy
+            new_domain = list(domains[var])
+            self.rng.shuffle(new_domain)
             return new_domain
         elif self.value_heuristic == self.LEAST_CONSTRAINING_VAL:
             return self.least_constraining_value(domains, var)
+        elif self.value_heuristic == self.LEAST_CONSTRAINING_VAL_COUNTS:
+            return self.least_constraining_value_counts(domains[var], var[self.ROW] * self.size + var[self.COL])
 
     def least_constraining_value(self, domains, var):
         """
@@ -299,51 +1134,96 @@ class Sudoku(object):
                     conflicts += 1
             sorted_domain.append((value, conflicts))
 
+        if self.random_tie_breaking:
+            # sorted is stable, so values with equal conflicts stay in shuffled order
+            self.rng.shuffle(sorted_domain)
         sorted_domain = sorted(sorted_domain, key=lambda pair: pair[1])
         return [pair[0] for pair in sorted_domain]
 
+    def least_constraining_value_counts(self, values, cell):
+        """
+        Returns values sorted by the number of cells in the row, col and box of cell that have
+        the value in their domain, read from unit_value_counts. Cells in both the box and the
+        row or col of cell are counted twice
+        """
+        counts = self.unit_value_counts
+        stride = self.size + 1
+        row_unit, col_unit, box_unit = self.graph.cell_units[cell]
+        row_unit *= stride
+        col_unit *= stride
+        box_unit *= stride
+        if self.random_tie_breaking:
+            values = list(values)
+            self.rng.shuffle(values)
+        return sorted(values, key=lambda value: counts[row_unit + value] + counts[col_unit + value]
+                      + counts[box_unit + value])
+
     """
     Inference
     """
-    def inference(self, state, domains, var, value, values_removed):
+    def inference(self, state, domains, var, value):
         """
         For now just remove the domain of the current var and return the new
         domains. NOTE: DEEPCOPY THE DOMAIN!!
         """
         if self.inference_heuristic == self.FORWARD_CHECKING:
-            return self.forward_checking(state, domains, var, value, values_removed)
+            return self.forward_checking(state, domains, var, value)
         elif self.inference_heuristic == self.AC3:
-            new_domains = self.ac3(state, domains, values_removed)
+            new_domains = self.ac3(state, domains)
             return new_domains
+        elif self.inference_heuristic == self.AC3_INCREMENTAL:
+            return self.ac3(state, domains, assigned_var=var)
+        elif self.inference_heuristic == self.AC3_RESIDUAL:
+            return self.ac3(state, domains, assigned_var=var, revise=self.revise_residual)
 
-    def ac3(self, state, domains, values_removed):
+    def ac3(self, state, domains, assigned_var=None, revise=None):
+        """
+        If assigned_var is given, the domains are assumed to have been arc consistent before
+        assigned_var was assigned, so only the arcs pointing at assigned_var are queued initially.
+        revise defaults to self.revise
+        """
+        if revise is None:
+            revise = self.revise
+        neighbour_arcs = self.graph.get_neighbour_arcs()
         # initialize queue of arcs
         queue = deque()
-        unassigned_var = self.get_unassigned_variables(state)
-        for x in unassigned_var:
-            # get unassigned neighbours as well to remove unnecessary iteration of values
-            # that have already been assigned to neighbouring variables
-            neighbours = self.neighbours_dict[x]
-            for y in neighbours:
-                queue.append((x, y))
+        if assigned_var is None:
+            unassigned_var = self.get_unassigned_variables(state)
+            for x in unassigned_var:
+                # get unassigned neighbours as well to remove unnecessary iteration of values
+                # that have already been assigned to neighbouring variables
+                neighbours = self.neighbours_dict[x]
+                for y in neighbours:
+                    queue.append((x, y))
+        else:
+            for x in self.neighbours_dict[assigned_var]:
+                if state[x[self.ROW]][x[self.COL]] == 0:
+                    queue.append((x, assigned_var))
+        # Arcs currently in the queue, so that no arc is queued twice
+        queued = set(queue)
 
         while len(queue) > 0:
-            x, y = queue.popleft()
+            arc = queue.popleft()
+            queued.remove(arc)
+            x, y = arc
             # print("x: {} y: {}".format(x, y))
-            if self.revise(domains, x, y, values_removed):
+            if revise(domains, x, y):
                 # self.print_domains(state, domains)
                 if len(domains[x]) == 0:
                     # print("({},{})'s domain is gone".format(x[self.ROW], x[self.COL]))
+                    if self.unit_weights is not None:
+                        self.bump_constraint_weights(x[self.ROW] * self.size + x[self.COL],
+                                                     y[self.ROW] * self.size + y[self.COL])
                     return None
 
-                # Return new list to prevent mutation of neighbours_dict
-                neighbours = list(self.neighbours_dict[x])
-                neighbours.remove(y)
-                for neighbour in neighbours:
-                    queue.append((neighbour, x))
+                for neighbour in neighbour_arcs[arc]:
+                    arc = (neighbour, x)
+                    if arc not in queued:
+                        queued.add(arc)
+                        queue.append(arc)
         return domains
 
-    def revise(self, domains, x, y, values_removed):
+    def revise(self, domains, x, y):
         revised = False
         x_domain = domains[x]
         # print("Var {}'s domain: {}".format(x, x_domain))
@@ -352,19 +1232,43 @@ class Sudoku(object):
             y_domain = domains[y]
             has_diff_val = False
             for y_val in y_domain:
+                self.support_checks += 1
                 if x_val != y_val:
                     has_diff_val = True
                     break
             if not has_diff_val:
-                x_domain.remove(x_val)
-                if x in values_removed:
-                    values_removed[x].add(x_val)
-                else:
-                    values_removed[x] = set([x_val])
+                self.remove_value(domains, x, x_val)
+                revised = True
+        return revised
+
+    def revise_residual(self, domains, x, y):
+        """
+        revise with residual supports (AC-3rm). The support last found for each value of x is
+        looked up first, and y's domain is only searched again once that support has been
+        pruned. Residues are not restored on backtracking, a stale one just fails the lookup
+        """
+        revised = False
+        residues = self.residues.get((x, y))
+        if residues is None:
+            residues = self.residues[(x, y)] = [0] * (self.size + 1)
+        y_domain = domains[y]
+        for x_val in list(domains[x]):
+            if residues[x_val] in y_domain:
+                self.residue_hits += 1
+                continue
+            has_diff_val = False
+            for y_val in y_domain:
+                self.support_checks += 1
+                if x_val != y_val:
+                    residues[x_val] = y_val
+                    has_diff_val = True
+                    break
+            if not has_diff_val:
+                self.remove_value(domains, x, x_val)
                 revised = True
         return revised
 
-    def forward_checking(self, state, domains, var, value, values_removed, propagated_neighbours=[]):
+    def forward_checking(self, state, domains, var, value, propagated_neighbours=[]):
         """
         Returns the domains of a particular state
         """
@@ -374,37 +1278,939 @@ class Sudoku(object):
 
         for neighbour in neighbours:
             domain = domains[neighbour]
-            if value in list(domain):
+            if value in domain:
                 if len(domain) == 1:
+                    if self.unit_weights is not None:
+                        self.bump_constraint_weights(neighbour[self.ROW] * self.size + neighbour[self.COL],
+                                                     var[self.ROW] * self.size + var[self.COL])
                     return None
-                domain.remove(value)
-                if neighbour in values_removed:
-                    values_removed[neighbour].add(value)
-                else:
-                    values_removed[neighbour] = set([value])
+                self.remove_value(domains, neighbour, value)
 
                 # Propagation of singleton domains after removal
                 if len(domain) == 1:
-                    neighbours_to_propagate = list(self.neighbours_dict[neighbour])
-                    neighbours_to_propagate.remove(var)
-                    if self.forward_checking(state, domains, neighbour, list(domain)[0], values_removed,
+                    neighbours_to_propagate = self.graph.get_neighbour_arcs()[(neighbour, var)]
+                    if self.forward_checking(state, domains, neighbour, list(domain)[0],
                                              propagated_neighbours=neighbours_to_propagate) is None:
                         return None
 
         return domains
 
+    """
+    Bitmask Domains
+
+    masks: flat list of num_cells ints indexed by cell number (row * size + col). Bit
+    (value - 1) of masks[cell] is set if value is in the domain of that cell.
+    """
+    def solve_bitmask(self):
+        masks = self.prepare_bitmask_search()
+        if masks is None:
+            return None
+        if self.search_algorithm == self.CONFLICT_DIRECTED_BACKJUMPING:
+            # Removals so far follow from the givens alone, so every conflict set starts empty
+            self.conflict_sets = [0] * self.num_cells
+            self.trail_conflicts = [0] * (self.num_cells * self.size)
+            self.cell_levels = [-1] * self.num_cells
+            self.level_literals = [0] * self.num_cells
+            self.depth = -1
+            return self.run_back_jumping(self.puzzle, masks, 0)
+        if self.search_algorithm == self.ITERATIVE_BACKTRACKING:
+            self.start_iterative_search(masks)
+            return self.resume_search(self.search_slice)
+        return self.run_back_tracking_bitmask(self.puzzle, masks)
+
+    def prepare_bitmask_search(self):
+        """
+        Returns the masks of self.puzzle after the initial propagation, with the state kept by
+        the selected heuristics built from them, or None if the puzzle has no solution
+        """
+        masks = self.get_initial_fc_masks(self.puzzle)
+        if masks is None:
+            return None
+        if self.initial_masks is not None:
+            for cell in range(self.num_cells):
+                masks[cell] &= self.initial_masks[cell]
+                if masks[cell] == 0:
+                    return None
+        if self.inference_heuristic == self.RULE_PROPAGATION:
+            if self.propagate_rules(self.puzzle, masks) is None:
+                return None
+        elif self.inference_heuristic == self.ALL_DIFFERENT_GAC:
+            self.unit_matchings = [[-1] * self.size for unit in self.graph.units]
+            if self.propagate_all_different(self.puzzle, masks, range(len(self.graph.units))) is None:
+                return None
+        if self.variable_heuristic == self.MOST_CONSTRAINED_VAR_BUCKETS:
+            domain_sizes = {}
+            for cell in range(self.num_cells):
+                if self.puzzle[cell // self.size][cell % self.size] == 0:
+                    domain_sizes[cell] = self.popcount(masks[cell])
+            self.buckets = DomainBuckets(range(self.num_cells), self.peers, domain_sizes, self.size)
+        if self.value_heuristic == self.LEAST_CONSTRAINING_VAL_COUNTS:
+            self.unit_value_counts = [0] * (3 * self.size * (self.size + 1))
+            for cell in range(self.num_cells):
+                for value in self.mask_values(masks[cell]):
+                    self.update_unit_value_counts(cell, value, 1)
+        return masks
+
+    def expand_root(self):
+        """
+        Returns the children of the root of the bitmask search of self.puzzle as (state, masks)
+        pairs of partial assignment and pruned domains, one per value of the first variable
+        that survives inference, in the order the search would try them. Returns [] if the
+        puzzle has no solution and [(state, masks)] if the givens already solve it
+        """
+        self.reset_trail()
+        masks = self.prepare_bitmask_search()
+        if masks is None:
+            return []
+        state = self.puzzle
+        if self.is_goal_state(state):
+            return [(state, masks)]
+
+        var = self.select_unassigned_cell(state, masks)
+        var_row, var_col = divmod(var, self.size)
+        children = []
+        for value in self.order_mask_values(masks, var):
+            state[var_row][var_col] = value
+            if self.buckets is not None:
+                self.buckets.assign(var)
+            self.push_trail_mark()
+            self.remove_bits(masks, var, masks[var] & ~(1 << (value - 1)))
+
+            if self.inference_bitmask(state, masks, var, value) is not None:
+                children.append(([row[:] for row in state], list(masks)))
+
+            self.restore_masks(masks)
+            if self.buckets is not None:
+                self.buckets.unassign(var, self.popcount(masks[var]))
+            state[var_row][var_col] = 0
+        return children
+
+    def run_back_tracking_bitmask(self, state, masks):
+        self.count += 1
+        if self.node_limit is not None and self.count > self.node_limit:
+            raise NodeLimitReached()
+        if self.is_goal_state(state):
+            return state
+
+        var = self.select_unassigned_cell(state, masks)
+        var_row, var_col = divmod(var, self.size)
+
+        for value in self.order_mask_values(masks, var):
+            state[var_row][var_col] = value
+            if self.buckets is not None:
+                self.buckets.assign(var)
+            self.push_trail_mark()
+            self.remove_bits(masks, var, masks[var] & ~(1 << (value - 1)))
+
+            if self.inference_bitmask(state, masks, var, value) is not None:
+                result = self.run_back_tracking_bitmask(state, masks)
+
+                if result is not None:
+                    return result
+
+            self.restore_masks(masks)
+            if self.buckets is not None:
+                self.buckets.unassign(var, self.popcount(masks[var]))
+
+            state[var_row][var_col] = 0
+
+        return None
+
+    def run_back_jumping(self, state, masks, depth):
+        """
+        Conflict directed backjumping (FC-CBJ). Returns the solved state, or None with the levels
+        whose assignments caused the failure in self.jump_conflicts. A failed subtree that does
+        not depend on the assignment at this depth returns straight away instead of trying the
+        other values, jumping back to the deepest level in its conflict set
+        """
+        self.count += 1
+        if self.node_limit is not None and self.count > self.node_limit:
+            raise NodeLimitReached()
+        if self.is_goal_state(state):
+            return state
+
+        var = self.select_unassigned_cell(state, masks)
+        var_row, var_col = divmod(var, self.size)
+        depth_bit = 1 << depth
+        # Values pruned before var is assigned are explained by its conflict set
+        node_conflicts = self.conflict_sets[var]
+
+        for value in self.order_mask_values(masks, var):
+            state[var_row][var_col] = value
+            self.depth = depth
+            self.cell_levels[var] = depth
+            literal = var * self.size + value - 1
+            self.level_literals[depth] = literal
+            if self.buckets is not None:
+                self.buckets.assign(var)
+            self.push_trail_mark()
+            self.remove_bits(masks, var, masks[var] & ~(1 << (value - 1)), var)
+
+            self.failure_conflicts = None
+            conflicts = self.violated_nogood(state, literal, depth_bit)
+            if conflicts is None:
+                if self.inference_bitmask(state, masks, var, value) is not None:
+                    result = self.run_back_jumping(state, masks, depth + 1)
+
+                    if result is not None:
+                        return result
+                    conflicts = self.jump_conflicts
+                else:
+                    conflicts = self.failure_conflicts
+                    if conflicts is None:
+                        conflicts = (depth_bit << 1) - 1
+
+            self.restore_masks(masks)
+            if self.buckets is not None:
+                self.buckets.unassign(var, self.popcount(masks[var]))
+
+            self.cell_levels[var] = -1
+            state[var_row][var_col] = 0
+
+            if not conflicts & depth_bit:
+                self.jump_conflicts = conflicts
+                return None
+            node_conflicts |= conflicts & ~depth_bit
+
+        self.record_nogood(node_conflicts)
+        self.jump_conflicts = node_conflicts
+        return None
+
+    def reason_of(self, cell):
+        """
+        Returns the levels that explain the value of cell: its own level if assigned, otherwise
+        the levels that removed its other values
+        """
+        level = self.cell_levels[cell]
+        if level >= 0:
+            return 1 << level
+        return self.conflict_sets[cell]
+
+    def violated_nogood(self, state, literal, depth_bit):
+        """
+        Returns the levels of a recorded nogood completed by the assignment literal, or None
+        """
+        size = self.size
+        for others in self.nogoods.get(literal, ()):
+            conflicts = depth_bit
+            for other in others:
+                cell, value_index = divmod(other, size)
+                if state[cell // size][cell % size] != value_index + 1:
+                    break
+                conflicts |= 1 << self.cell_levels[cell]
+            else:
+                return conflicts
+        return None
+
+    def record_nogood(self, levels):
+        """
+        Records the assignments at levels as a combination that has no solution, if it is small
+        """
+        if levels == 0 or popcount(levels) > MAX_NOGOOD_SIZE:
+            return
+        nogood = tuple(sorted(self.level_literals[value - 1] for value in self.mask_values(levels)))
+        if nogood in self.nogood_set:
+            return
+        self.nogood_set.add(nogood)
+        for literal in nogood:
+            self.nogoods.setdefault(literal, []).append(tuple(other for other in nogood if other != literal))
+
+    def remove_bits(self, masks, cell, bits, reason_cell=None):
+        """
+        reason_cell is the cell whose value caused the removal, if there is a single one. It is
+        only used to explain the removal when backjumping
+        """
+        masks[cell] &= ~bits
+        top = self.trail_top
+        self.trail[top] = cell
+        self.trail[top + 1] = bits
+        self.trail_top = top + 2
+        if self.conflict_sets is not None:
+            self.trail_conflicts[top >> 1] = self.conflict_sets[cell]
+            if reason_cell is None:
+                # Removals by the unit rules depend on many cells, so blame every assignment
+                self.conflict_sets[cell] |= (1 << (self.depth + 1)) - 1
+            else:
+                self.conflict_sets[cell] |= self.reason_of(reason_cell)
+        if self.buckets is not None:
+            self.buckets.resize(cell, self.popcount(masks[cell]))
+        if self.unit_value_counts is not None:
+            for value in self.mask_values(bits):
+                self.update_unit_value_counts(cell, value, -1)
+
+    def restore_masks(self, masks):
+        mark = self.trail_marks.pop()
+        trail = self.trail
+        top = self.trail_top
+        while top > mark:
+            top -= 2
+            cell = trail[top]
+            masks[cell] |= trail[top + 1]
+            if self.conflict_sets is not None:
+                self.conflict_sets[cell] = self.trail_conflicts[top >> 1]
+            if self.buckets is not None:
+                self.buckets.resize(cell, self.popcount(masks[cell]))
+            if self.unit_value_counts is not None:
+                for value in self.mask_values(trail[top + 1]):
+                    self.update_unit_value_counts(cell, value, 1)
+        self.trail_top = mark
+
+    def mask_values(self, mask):
+        """
+        Returns the values in mask in ascending order by repeatedly taking the lowest set bit
+        """
+        values = []
+        while mask:
+            lowest_bit = mask & -mask
+            values.append(lowest_bit.bit_length())
+            mask ^= lowest_bit
+        return values
+
+    def get_initial_fc_masks(self, state):
+        size = self.size
+        masks = [self.all_values_mask] * self.num_cells
+        for row in range(size):
+            for col in range(size):
+                if state[row][col] != 0:
+                    masks[row * size + col] = 1 << (state[row][col] - 1)
+        for row in range(size):
+            for col in range(size):
+                val = state[row][col]
+                if val != 0:
+                    if self.forward_checking_bitmask(state, masks, row * size + col, val) is None:
+                        return None
+        return masks
+
+    def select_unassigned_cell(self, state, masks):
+        if self.variable_heuristic == self.FIRST_UNASSIGNED_VAR:
+            row, col = self.first_unassigned(state)
+            return row * self.size + col
+        elif self.variable_heuristic == self.MOST_CONSTRAINED_VAR:
+            return self.most_constrained_cell(state, masks)
+        elif self.variable_heuristic == self.MOST_CONSTRAINED_VAR_BUCKETS:
+            return self.buckets.most_constrained()
+        elif self.variable_heuristic == self.DOM_WDEG:
+            popcount = self.popcount
+            return self.dom_wdeg_cell(state, lambda cell: popcount(masks[cell]))
+
+    def most_constrained_cell(self, state, masks):
+        """
+        Returns unassigned cell with the smallest mask popcount, with most constraining cell
+        as tie break
+        """
+        size = self.size
+        popcount = self.popcount
+        results = []
+        min_domain_length = size + 1
+        for cell in range(self.num_cells):
+            row, col = divmod(cell, size)
+            if state[row][col] == 0:
+                domain_length = popcount(masks[cell])
+                if domain_length < min_domain_length:
+                    results = [cell]
+                    min_domain_length = domain_length
+                elif domain_length == min_domain_length:
+                    results.append(cell)
+
+        result = results[0]
+        max_constraints = -1
+        for cell in results:
+            constraints = 0
+            for peer in self.peers[cell]:
+                if state[peer // size][peer % size] == 0:
+                    constraints += 1
+            if constraints > max_constraints:
+                max_constraints = constraints
+                result = cell
+                ties = 1
+            elif constraints == max_constraints and self.random_tie_breaking:
+                ties += 1
+                if self.rng.randrange(ties) == 0:
+                    result = cell
+        return result
+
+    def order_mask_values(self, masks, var):
+        if self.value_heuristic == self.RANDOM_SHUFFLE:
+            values = self.mask_values(masks[var])
+            self.rng.shuffle(values)
+            return values
+        elif self.value_heuristic == self.LEAST_CONSTRAINING_VAL:
+            return self.least_constraining_mask_value(masks, var)
+        elif self.value_heuristic == self.LEAST_CONSTRAINING_VAL_COUNTS:
+            return self.least_constraining_value_counts(self.mask_values(masks[var]), var)
+
+    def least_constraining_mask_value(self, masks, var):
+        """
+        Returns values of var sorted by the number of peers whose mask contains the same bit
+        """
+        sorted_domain = []
+        for value in self.mask_values(masks[var]):
+            bit = 1 << (value - 1)
+            conflicts = 0
+            for peer in self.peers[var]:
+                if masks[peer] & bit:
+                    conflicts += 1
+            sorted_domain.append((value, conflicts))
+
+        if self.random_tie_breaking:
+            # sorted is stable, so values with equal conflicts stay in shuffled order
+            self.rng.shuffle(sorted_domain)
+        sorted_domain = sorted(sorted_domain, key=lambda pair: pair[1])
+        return [pair[0] for pair in sorted_domain]
+
+    def inference_bitmask(self, state, masks, var, value):
+        if self.inference_heuristic == self.FORWARD_CHECKING:
+            return self.forward_checking_bitmask(state, masks, var, value)
+        elif self.inference_heuristic == self.AC3:
+            return self.ac3_bitmask(state, masks)
+        elif self.inference_heuristic in (self.AC3_INCREMENTAL, self.AC3_RESIDUAL):
+            # revise_bitmask already finds a support with a single check, so there is nothing
+            # for residues to save
+            return self.ac3_bitmask(state, masks, assigned_var=var)
+        elif self.inference_heuristic == self.RULE_PROPAGATION:
+            if self.forward_checking_bitmask(state, masks, var, value) is None:
+                return None
+            return self.propagate_rules(state, masks)
+        elif self.inference_heuristic == self.ALL_DIFFERENT_GAC:
+            if self.forward_checking_bitmask(state, masks, var, value) is None:
+                return None
+            return self.propagate_all_different(state, masks, self.graph.cell_units[var])
+
+    def ac3_bitmask(self, state, masks, assigned_var=None):
+        size = self.size
+        num_cells = self.num_cells
+        arc_successors = self.graph.get_arc_successors()
+        queue = deque()
+        if assigned_var is None:
+            for x in range(num_cells):
+                if state[x // size][x % size] == 0:
+                    for y in self.peers[x]:
+                        queue.append((x, y))
+        else:
+            for x in self.peers[assigned_var]:
+                if state[x // size][x % size] == 0:
+                    queue.append((x, assigned_var))
+        queued = set(queue)
+
+        while len(queue) > 0:
+            arc = queue.popleft()
+            queued.remove(arc)
+            x, y = arc
+            if self.revise_bitmask(masks, x, y):
+                if masks[x] == 0:
+                    if self.unit_weights is not None:
+                        self.bump_constraint_weights(x, y)
+                    if self.conflict_sets is not None:
+                        self.failure_conflicts = self.conflict_sets[x] | self.reason_of(x)
+                    return None
+
+                for neighbour in arc_successors[x * num_cells + y]:
+                    arc = (neighbour, x)
+                    if arc not in queued:
+                        queued.add(arc)
+                        queue.append(arc)
+        return masks
+
+    def revise_bitmask(self, masks, x, y):
+        """
+        A value of x only loses its support on the arc x != y when y has that value as its
+        only value, so revise is a single check of whether y's mask is a single bit in x's mask
+        """
+        self.support_checks += 1
+        y_mask = masks[y]
+        if y_mask & (y_mask - 1) or not masks[x] & y_mask:
+            return False
+        self.remove_bits(masks, x, y_mask, y)
+        return True
+
+    def forward_checking_bitmask(self, state, masks, var, value, propagated_neighbours=None):
+        bit = 1 << (value - 1)
+        neighbours = self.peers[var]
+        if propagated_neighbours:
+            neighbours = propagated_neighbours
+
+        for neighbour in neighbours:
+            mask = masks[neighbour]
+            if mask & bit:
+                if mask == bit:
+                    if self.unit_weights is not None:
+                        self.bump_constraint_weights(neighbour, var)
+                    if self.conflict_sets is not None:
+                        self.failure_conflicts = (self.conflict_sets[neighbour] | self.reason_of(neighbour)
+                                                  | self.reason_of(var))
+                    return None
+                self.remove_bits(masks, neighbour, bit, var)
+                mask ^= bit
+
+                # Propagation of singleton domains after removal
+                if mask & (mask - 1) == 0:
+                    arc = neighbour * self.num_cells + var
+                    neighbours_to_propagate = self.graph.get_arc_successors()[arc]
+                    if self.forward_checking_bitmask(state, masks, neighbour, mask.bit_length(),
+                                                     propagated_neighbours=neighbours_to_propagate) is None:
+                        return None
+
+        return masks
+
+    """
+    Rule Propagation
+
+    Each rule returns None if it wipes out a domain or finds a value with no place left in a
+    unit, True if it removed any value and False otherwise. Removals go through remove_bits,
+    so they are undone with the rest of the trail on backtracking.
+    """
+    def propagate_rules(self, state, masks):
+        """
+        Applies the unit rules, cheapest first, until none of them removes a value
+        """
+        rules = (self.hidden_singles,
+                 self.pointing_and_claiming,
+                 lambda state, masks: self.naked_subsets(state, masks, 2),
+                 lambda state, masks: self.hidden_subsets(state, masks, 2),
+                 lambda state, masks: self.naked_subsets(state, masks, 3),
+                 lambda state, masks: self.hidden_subsets(state, masks, 3))
+        rule_index = 0
+        while rule_index < len(rules):
+            changed = rules[rule_index](state, masks)
+            if changed is None:
+                return None
+            # Start again from the cheapest rule after any removal
+            rule_index = 0 if changed else rule_index + 1
+        return masks
+
+    def eliminate(self, state, masks, cell, bits):
+        """
+        Removes bits from the mask of cell, forward checking the last value if only one is left.
+        Returns None if a domain is wiped out, True if any bit was removed and False otherwise
+        """
+        bits &= masks[cell]
+        if not bits:
+            return False
+        mask = masks[cell] & ~bits
+        if not mask:
+            return None
+        self.remove_bits(masks, cell, bits)
+        if mask & (mask - 1) == 0:
+            if self.forward_checking_bitmask(state, masks, cell, mask.bit_length()) is None:
+                return None
+        return True
+
+    def hidden_singles(self, state, masks):
+        """
+        Assigns each value that has only one possible cell in a unit to that cell
+        """
+        changed = False
+        for unit in self.graph.units:
+            seen_once = 0
+            seen_twice = 0
+            for cell in unit:
+                seen_twice |= seen_once & masks[cell]
+                seen_once |= masks[cell]
+            if seen_once != self.all_values_mask:
+                return None
+
+            singles = seen_once & ~seen_twice
+            while singles:
+                bit = singles & -singles
+                singles ^= bit
+                for cell in unit:
+                    if masks[cell] & bit:
+                        result = self.eliminate(state, masks, cell, masks[cell] & ~bit)
+                        if result is None:
+                            return None
+                        changed = changed or result
+                        break
+        return changed
+
+    def pointing_and_claiming(self, state, masks):
+        """
+        Pointing: a value that can only be in one row or col of a box is removed from the rest of
+        that row or col. Claiming: a value that can only be in one box of a row or col is
+        removed from the rest of that box
+        """
+        changed = False
+        for segment, box_rest, line_rest in self.graph.intersections:
+            segment_mask = 0
+            for cell in segment:
+                segment_mask |= masks[cell]
+            box_rest_mask = 0
+            for cell in box_rest:
+                box_rest_mask |= masks[cell]
+            line_rest_mask = 0
+            for cell in line_rest:
+                line_rest_mask |= masks[cell]
+
+            pointing = segment_mask & ~box_rest_mask & line_rest_mask
+            if pointing:
+                for cell in line_rest:
+                    result = self.eliminate(state, masks, cell, pointing)
+                    if result is None:
+                        return None
+                    changed = changed or result
+            claiming = segment_mask & ~line_rest_mask & box_rest_mask
+            if claiming:
+                for cell in box_rest:
+                    result = self.eliminate(state, masks, cell, claiming)
+                    if result is None:
+                        return None
+                    changed = changed or result
+        return changed
+
+    def naked_subsets(self, state, masks, subset_size):
+        """
+        If subset_size cells of a unit only have subset_size values between them, those values
+        are removed from the other cells of the unit
+        """
+        changed = False
+        popcount = self.popcount
+        for unit in self.graph.units:
+            candidates = [cell for cell in unit if 2 <= popcount(masks[cell]) <= subset_size]
+            for subset in combinations(candidates, subset_size):
+                subset_mask = 0
+                for cell in subset:
+                    subset_mask |= masks[cell]
+                subset_mask_size = popcount(subset_mask)
+                if subset_mask_size < subset_size:
+                    return None
+                if subset_mask_size == subset_size:
+                    for cell in unit:
+                        if cell not in subset:
+                            result = self.eliminate(state, masks, cell, subset_mask)
+                            if result is None:
+                                return None
+                            changed = changed or result
+        return changed
+
+    def hidden_subsets(self, state, masks, subset_size):
+        """
+        If subset_size values of a unit can only be in subset_size cells between them, the other
+        values are removed from those cells
+        """
+        changed = False
+        popcount = self.popcount
+        for unit in self.graph.units:
+            # positions[value_index] has bit i set if value is in the domain of unit[i]
+            positions = [0] * self.size
+            for i, cell in enumerate(unit):
+                for value in self.mask_values(masks[cell]):
+                    positions[value - 1] |= 1 << i
+            candidates = [value_index for value_index in range(self.size)
+                          if 2 <= popcount(positions[value_index]) <= subset_size]
+            for subset in combinations(candidates, subset_size):
+                subset_positions = 0
+                subset_mask = 0
+                for value_index in subset:
+                    subset_positions |= positions[value_index]
+                    subset_mask |= 1 << value_index
+                subset_positions_size = popcount(subset_positions)
+                if subset_positions_size < subset_size:
+                    return None
+                if subset_positions_size == subset_size:
+                    for i in self.mask_values(subset_positions):
+                        cell = unit[i - 1]
+                        result = self.eliminate(state, masks, cell, masks[cell] & ~subset_mask)
+                        if result is None:
+                            return None
+                        changed = changed or result
+        return changed
+
+    """
+    All Different
+
+    Each unit is an all different constraint between its cells and the values 1 to size. A
+    value is removed from a cell unless the edge between them is in some maximum matching of
+    the unit's bipartite cell-value graph (Regin's algorithm). As a unit has as many cells as
+    values, every matching found is perfect and this reduces to keeping the matched edges and
+    the edges inside a strongly connected component of the alternating graph.
+    """
+    def propagate_all_different(self, state, masks, units):
+        """
+        Runs all_different_gac on units, and then on every unit of a cell whose mask changes,
+        until no more values are removed
+        """
+        queue = deque(units)
+        queued = set(queue)
+        # Cells logged on the trail from here on have had values removed
+        checked = self.trail_top
+        while queue:
+            unit = queue.popleft()
+            queued.remove(unit)
+            if self.all_different_gac(state, masks, unit) is None:
+                return None
+
+            while checked < self.trail_top:
+                for changed_unit in self.graph.cell_units[self.trail[checked]]:
+                    if changed_unit not in queued:
+                        queued.add(changed_unit)
+                        queue.append(changed_unit)
+                checked += 2
+        return masks
+
+    def all_different_gac(self, state, masks, unit_index):
+        unit = self.graph.units[unit_index]
+        unit_masks = [masks[cell] for cell in unit]
+        matching = self.unit_matchings[unit_index]
+
+        # Keep the matched edges that are still in the domains
+        value_owner = [-1] * self.size
+        for i in range(len(unit)):
+            value_index = matching[i]
+            if value_index >= 0 and unit_masks[i] >> value_index & 1 and value_owner[value_index] < 0:
+                value_owner[value_index] = i
+            else:
+                matching[i] = -1
+        if not self.hopcroft_karp(unit_masks, matching, value_owner):
+            return None
+
+        components = self.alternating_components(unit_masks, matching, value_owner)
+        for i, cell in enumerate(unit):
+            unsupported = 0
+            for value in self.mask_values(unit_masks[i] & ~(1 << matching[i])):
+                if components[value_owner[value - 1]] != components[i]:
+                    unsupported |= 1 << (value - 1)
+            if unsupported and self.eliminate(state, masks, cell, unsupported) is None:
+                return None
+        return masks
+
+    def hopcroft_karp(self, unit_masks, matching, value_owner):
+        """
+        Extends matching (cell position -> value index) and value_owner (value index -> cell
+        position) to a perfect matching along shortest augmenting paths. Returns False if the
+        unit has no perfect matching
+        """
+        num_positions = len(unit_masks)
+        while True:
+            # Layer the cell positions by breadth first search from the unmatched ones
+            free = [i for i in range(num_positions) if matching[i] < 0]
+            if not free:
+                return True
+            distance = [-1] * num_positions
+            for i in free:
+                distance[i] = 0
+            queue = deque(free)
+            found_free_value = False
+            while queue:
+                i = queue.popleft()
+                for value in self.mask_values(unit_masks[i]):
+                    owner = value_owner[value - 1]
+                    if owner < 0:
+                        found_free_value = True
+                    elif distance[owner] < 0:
+                        distance[owner] = distance[i] + 1
+                        queue.append(owner)
+            if not found_free_value:
+                return False
+
+            augmented = False
+            for i in free:
+                if self.augment_matching(i, unit_masks, matching, value_owner, distance):
+                    augmented = True
+            if not augmented:
+                return False
+
+    def augment_matching(self, i, unit_masks, matching, value_owner, distance):
+        for value in self.mask_values(unit_masks[i]):
+            owner = value_owner[value - 1]
+            if owner < 0 or (distance[owner] == distance[i] + 1 and
+                             self.augment_matching(owner, unit_masks, matching, value_owner, distance)):
+                matching[i] = value - 1
+                value_owner[value - 1] = i
+                return True
+        # Dead end, do not search from this position again in this phase
+        distance[i] = -1
+        return False
+
+    def alternating_components(self, unit_masks, matching, value_owner):
+        """
+        Returns the strongly connected component of each cell position in the graph with an
+        edge from i to j when j is matched to a value in the domain of i (Tarjan's algorithm)
+        """
+        num_positions = len(unit_masks)
+        successors = []
+        for i in range(num_positions):
+            successors.append([value_owner[value - 1]
+                               for value in self.mask_values(unit_masks[i] & ~(1 << matching[i]))])
+
+        index = [-1] * num_positions
+        low_link = [0] * num_positions
+        components = [-1] * num_positions
+        stack = []
+        on_stack = [False] * num_positions
+        counter = [0, 0]  # next index, next component
+
+        def strong_connect(i):
+            index[i] = low_link[i] = counter[0]
+            counter[0] += 1
+            stack.append(i)
+            on_stack[i] = True
+            for j in successors[i]:
+                if index[j] < 0:
+                    strong_connect(j)
+                    low_link[i] = min(low_link[i], low_link[j])
+                elif on_stack[j]:
+                    low_link[i] = min(low_link[i], index[j])
+            if low_link[i] == index[i]:
+                while True:
+                    j = stack.pop()
+                    on_stack[j] = False
+                    components[j] = counter[1]
+                    if j == i:
+                        break
+                counter[1] += 1
+
+        for i in range(num_positions):
+            if index[i] < 0:
+                strong_connect(i)
+        return components
+
+    """
+    Dancing Links
+
+    The puzzle is encoded as an exact cover problem with num_cells * size candidate rows, one
+    for each (cell, value) pair, and 4 * num_cells constraint columns: each cell has a value,
+    and each row, column and box has each value exactly once (729 rows and 324 columns for a
+    9x9 puzzle). Nodes are stored in parallel lists, where index 0 is the root, 1 to
+    4 * num_cells are the column headers and the rest are the candidate nodes.
+    """
+    def solve_dlx(self):
+        size = self.size
+        self.solutions_found = 0
+        self.build_dlx_matrix()
+
+        # Select the candidate rows of the given values before searching
+        for row in range(size):
+            for col in range(size):
+                value = self.puzzle[row][col]
+                if value != 0:
+                    node = self.dlx_row_nodes[(row * size + col) * size + value - 1]
+                    if not self.select_dlx_row(node):
+                        return None
+
+        solution = self.run_dlx_search([])
+        if solution is None:
+            return None
+
+        state = self.puzzle
+        for candidate in solution:
+            cell, value_index = divmod(candidate, size)
+            state[cell // size][cell % size] = value_index + 1
+        return state
+
+    def build_dlx_matrix(self):
+        graph = self.graph
+        self.dlx_left = list(graph.dlx_left)
+        self.dlx_right = list(graph.dlx_right)
+        self.dlx_up = list(graph.dlx_up)
+        self.dlx_down = list(graph.dlx_down)
+        self.dlx_size = list(graph.dlx_size)
+        # Never modified during the search, so shared with the graph
+        self.dlx_column = graph.dlx_column
+        self.dlx_candidate = graph.dlx_candidate
+        self.dlx_row_nodes = graph.dlx_row_nodes
+
+    def select_dlx_row(self, node):
+        """
+        Covers every column of the row containing node. Returns False if one of them
+        is already covered, i.e. the given values conflict
+        """
+        j = node
+        while True:
+            column = self.dlx_column[j]
+            left = self.dlx_left[column]
+            if self.dlx_right[left] != column:
+                return False
+            self.cover(column)
+            j = self.dlx_right[j]
+            if j == node:
+                return True
+
+    def cover(self, column):
+        left, right, up, down = self.dlx_left, self.dlx_right, self.dlx_up, self.dlx_down
+        columns, size = self.dlx_column, self.dlx_size
+        left[right[column]] = left[column]
+        right[left[column]] = right[column]
+        i = down[column]
+        while i != column:
+            j = right[i]
+            while j != i:
+                up[down[j]] = up[j]
+                down[up[j]] = down[j]
+                size[columns[j]] -= 1
+                j = right[j]
+            i = down[i]
+
+    def uncover(self, column):
+        left, right, up, down = self.dlx_left, self.dlx_right, self.dlx_up, self.dlx_down
+        columns, size = self.dlx_column, self.dlx_size
+        i = up[column]
+        while i != column:
+            j = left[i]
+            while j != i:
+                size[columns[j]] += 1
+                up[down[j]] = j
+                down[up[j]] = j
+                j = left[j]
+            i = up[i]
+        left[right[column]] = column
+        right[left[column]] = column
+
+    def run_dlx_search(self, solution):
+        """
+        Knuth's Algorithm X, always branching on the column with the fewest remaining rows
+        """
+        self.count += 1
+        right, left, down = self.dlx_right, self.dlx_left, self.dlx_down
+        if right[0] == 0:
+            self.solutions_found += 1
+            if self.solution_limit is not None and self.solutions_found >= self.solution_limit:
+                return solution
+            return None
+
+        column = right[0]
+        min_size = self.dlx_size[column]
+        j = right[column]
+        while j != 0 and min_size > 1:
+            if self.dlx_size[j] < min_size:
+                column = j
+                min_size = self.dlx_size[j]
+            j = right[j]
+        if min_size == 0:
+            return None
+
+        self.cover(column)
+        r = down[column]
+        while r != column:
+            solution.append(self.dlx_candidate[r])
+            j = right[r]
+            while j != r:
+                self.cover(self.dlx_column[j])
+                j = right[j]
+
+            if self.run_dlx_search(solution) is not None:
+                return solution
+
+            solution.pop()
+            j = left[r]
+            while j != r:
+                self.uncover(self.dlx_column[j])
+                j = left[j]
+            r = down[r]
+        self.uncover(column)
+
+        return None
+
     def print_domains(self, state, domains):
         print("State:\n")
-        for i in range(9):
+        for i in range(self.size):
             print(state[i])
 
         sorted_keys = sorted(domains.keys())
 
         print("\nDomains:\n")
-        for i in range(9):
+        for i in range(self.size):
             row = ""
-            for j in range(9):
-                domain = domains[sorted_keys[i*9+j]]
+            for j in range(self.size):
+                domain = domains[sorted_keys[i*self.size+j]]
                 row += "{:25}".format(str(domain))
             print(row)
 
@@ -414,10 +2220,627 @@ class Sudoku(object):
     # Any other methods that you write should be used within the solve() method.
 
 
+def parse_value(token):
+    """
+    Returns the value of a cell written as a number, a letter (A = 10, B = 11, ..., Z = 35) or
+    0 / '.' for an empty cell
+    """
+    if token == '.':
+        return 0
+    if token.isdigit():
+        return int(token)
+    if len(token) == 1 and token.isalpha():
+        return ord(token.upper()) - ord('A') + 10
+    raise ValueError("Invalid cell value: {0}".format(token))
+
+
+def format_value(value, alphanumeric):
+    if alphanumeric and 9 < value <= MAX_LETTER_VALUE:
+        return chr(ord('A') + value - 10)
+    return str(value)
+
+
+def parse_puzzle(lines):
+    """
+    Returns (puzzle, order, alphanumeric) read from lines. Cells are separated by whitespace,
+    or written one character per cell if no line contains more than one token. alphanumeric
+    is always False for boards with values above MAX_LETTER_VALUE, which have no letter
+    """
+    tokens = [line.split() for line in lines]
+    if all(len(line_tokens) <= 1 for line_tokens in tokens):
+        cells = [char for line in lines for char in line.strip()]
+    else:
+        cells = [token for line_tokens in tokens for token in line_tokens]
+
+    size = int(round(len(cells) ** 0.5))
+    order = int(round(size ** 0.5))
+    if order ** 4 != len(cells):
+        raise ValueError("Puzzle must have order ** 4 cells, got {0}!".format(len(cells)))
+
+    values = [parse_value(cell) for cell in cells]
+    puzzle = [values[row * size:(row + 1) * size] for row in range(size)]
+    alphanumeric = size <= MAX_LETTER_VALUE and any(cell.isalpha() for cell in cells)
+    return puzzle, order, alphanumeric
+
+
+def format_line(cells, order, alphanumeric):
+    """
+    Writes a flat list of cell values on a single line, one character per cell, or separated by
+    spaces if the board has values above MAX_LETTER_VALUE
+    """
+    if order * order > MAX_LETTER_VALUE:
+        return " ".join(str(value) for value in cells)
+    # Values above 9 can only be written on a single line as letters
+    alphanumeric = alphanumeric or order > 3
+    return "".join(format_value(value, alphanumeric) for value in cells)
+
+
+def solve_line(line):
+    """
+    Solves a puzzle written on a single line, one character per cell. Returns the solution
+    in the same format, or the line unchanged if the puzzle has no solution
+    """
+    puzzle, order, alphanumeric = parse_puzzle([line])
+    ans = Sudoku(puzzle, order).find_solution()
+    if ans is None:
+        return line.strip()
+    return format_line([value for row in ans for value in row], order, alphanumeric)
+
+
+def solve_lines(lines):
+    if numpy is None:
+        return [solve_line(line) for line in lines]
+    puzzles = [parse_puzzle([line]) for line in lines]
+    order = puzzles[0][1] if puzzles else 3
+    if order > 4 or any(puzzle[1] != order for puzzle in puzzles):
+        return [solve_line(line) for line in lines]
+
+    answers = solve_puzzles_vectorized([puzzle[0] for puzzle in puzzles], order)
+    solutions = []
+    for line, (puzzle, order, alphanumeric), ans in zip(lines, puzzles, answers):
+        if ans is None:
+            solutions.append(line.strip())
+        else:
+            solutions.append(format_line([value for row in ans for value in row], order, alphanumeric))
+    return solutions
+
+
+# (peers, rows, cols, boxes) index arrays by order, see get_vectorized_indexes
+VECTORIZED_INDEXES = {}
+
+
+def get_vectorized_indexes(order):
+    """
+    Returns the constraint graph of the order as numpy index arrays: the peers of each cell,
+    and the cells of each row, col and box
+    """
+    if order not in VECTORIZED_INDEXES:
+        graph = get_constraint_graph(order)
+        size = graph.size
+        units = numpy.array(graph.units)
+        VECTORIZED_INDEXES[order] = (numpy.array(graph.peers), units[:size], units[size:2 * size],
+                                     units[2 * size:])
+    return VECTORIZED_INDEXES[order]
+
+
+def propagate_singles_vectorized(masks, order):
+    """
+    Applies naked and hidden singles to an (N, num_cells) uint16 array of candidate masks, one
+    row per puzzle, until no mask changes. Returns a bool array that is True for the puzzles
+    found to have no solution
+    """
+    size = order * order
+    peers, rows, cols, boxes = get_vectorized_indexes(order)
+    popcounts = numpy.array(POPCOUNT, dtype=numpy.uint8)
+    all_values_mask = (1 << size) - 1
+    failed = numpy.zeros(len(masks), dtype=bool)
+    # Puzzles whose masks changed in the last pass; the others are done
+    active = numpy.arange(len(masks))
+
+    while len(active) > 0:
+        previous = masks[active]
+        active_masks = previous.copy()
+        active_failed = numpy.zeros(len(active), dtype=bool)
+
+        # Naked singles: remove the value of every single cell from its peers
+        singles = numpy.where(popcounts[active_masks] == 1, active_masks, 0).astype(masks.dtype)
+        active_masks &= ~numpy.bitwise_or.reduce(singles[:, peers], axis=2)
+
+        # Hidden singles: a value in only one cell of a unit is that cell's value
+        for units in (rows, cols, boxes):
+            unit_masks = active_masks[:, units]
+            once = numpy.zeros(unit_masks.shape[:2], dtype=masks.dtype)
+            twice = numpy.zeros(unit_masks.shape[:2], dtype=masks.dtype)
+            for i in range(size):
+                twice |= once & unit_masks[:, :, i]
+                once |= unit_masks[:, :, i]
+            active_failed |= (once != all_values_mask).any(axis=1)
+            hidden = unit_masks & (once & ~twice)[:, :, numpy.newaxis]
+            active_masks[:, units] = numpy.where(hidden != 0, hidden, unit_masks)
+
+        active_failed |= (active_masks == 0).any(axis=1)
+        masks[active] = active_masks
+        failed[active] |= active_failed
+        changed = (active_masks != previous).any(axis=1) & ~active_failed
+        active = active[changed]
+    return failed
+
+
+def solve_puzzles_vectorized(puzzles, order=3):
+    """
+    Solves a list of puzzles of the same order, up to 16x16, together. Singles are propagated
+    for all of them at once with numpy, and only the puzzles that are left unsolved are given to
+    Sudoku, with the values found so far as extra givens. Returns the solved state of each
+    puzzle, or None for those with no solution
+    """
+    size = order * order
+    if len(puzzles) == 0:
+        return []
+    givens = numpy.array(puzzles, dtype=numpy.uint16).reshape(len(puzzles), size * size)
+    # A given value v is the mask with bit v - 1 set, an empty cell has every value
+    masks = numpy.where(givens != 0, numpy.left_shift(1, numpy.maximum(givens, 1) - 1),
+                        (1 << size) - 1).astype(numpy.uint16)
+    failed = propagate_singles_vectorized(masks, order)
+
+    values = numpy.zeros(1 << size, dtype=numpy.uint16)
+    for value in range(1, size + 1):
+        values[1 << (value - 1)] = value
+    states = values[masks].reshape(len(puzzles), size, size).tolist()
+
+    answers = []
+    for i in range(len(puzzles)):
+        if failed[i]:
+            answers.append(None)
+        elif all(value != 0 for row in states[i] for value in row):
+            answers.append(states[i])
+        else:
+            answers.append(Sudoku(states[i], order).find_solution())
+    return answers
+
+
+def is_puzzle_line(line):
+    """
+    Returns True if line parses as a puzzle, i.e. it is not a header
+    """
+    try:
+        return parse_puzzle([line])[1] > 1
+    except ValueError:
+        return False
+
+
+def read_mmap_lines(f):
+    """
+    Yields the lines of f from a memory map, so the file is never read into memory as a whole
+    """
+    if os.fstat(f.fileno()).st_size == 0:
+        return
+    mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for line in iter(mapped_file.readline, b""):
+            yield line.decode("ascii")
+    finally:
+        mapped_file.close()
+
+
+def read_puzzles(f, use_mmap=False):
+    """
+    Yields puzzles one line at a time from f. Lines may also be in the puzzle,solution CSV
+    layout, in which case only the puzzle is used and a header line is skipped. use_mmap is
+    ignored unless f is a regular file, since pipes cannot be memory-mapped
+    """
+    if use_mmap and not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+        sys.stderr.write("--mmap needs a regular file, reading the input line by line instead\n")
+        use_mmap = False
+    lines = read_mmap_lines(f) if use_mmap else f
+    for line_number, line in enumerate(lines):
+        puzzle = line.split(",", 1)[0].strip()
+        if not puzzle or (line_number == 0 and not is_puzzle_line(puzzle)):
+            continue
+        yield puzzle
+
+
+def solve_puzzles(puzzles, processes=None, cache=None):
+    """
+    Yields the solutions of puzzles in order, solving them in chunks on a pool of processes
+    (one per core by default). Only a bounded number of chunks is ever in flight, so a stream
+    of any length is solved in constant memory. With a SolutionCache, puzzles are looked up in
+    this process and only the misses are sent to the pool, their solutions being added to it
+    """
+    puzzles = iter(puzzles)
+    processes = processes or multiprocessing.cpu_count()
+    chunk_size = BATCH_CHUNK_SIZE if numpy is None else VECTORIZED_CHUNK_SIZE
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = deque()
+        while True:
+            chunk = list(islice(puzzles, chunk_size))
+            if chunk:
+                if cache is None:
+                    pending.append((None, pool.apply_async(solve_lines, (chunk,))))
+                else:
+                    lookups = [lookup_line(line, cache) for line in chunk]
+                    misses = [line for line, lookup in zip(chunk, lookups) if lookup[0] is None]
+                    pending.append((lookups, pool.apply_async(solve_lines, (misses,))))
+            if pending and (not chunk or len(pending) >= processes * BATCH_CHUNKS_PER_PROCESS):
+                lookups, result = pending.popleft()
+                solutions = iter(result.get())
+                if lookups is None:
+                    for solution in solutions:
+                        yield solution
+                    continue
+                for solution, canonical, order in lookups:
+                    if solution is None:
+                        solution = next(solutions)
+                        if canonical is not None:
+                            cells = [value for row in parse_puzzle([solution])[0] for value in row]
+                            if 0 not in cells:
+                                cache.put(canonical, cells, order)
+                    yield solution
+            elif not chunk:
+                break
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def lookup_line(line, cache):
+    """
+    Returns (solution line or None, canonical form, order) for a puzzle written on a single line.
+    Puzzles above CACHE_MAX_ORDER bypass the cache, with None as canonical form
+    """
+    puzzle, order, alphanumeric = parse_puzzle([line])
+    if order > CACHE_MAX_ORDER:
+        return None, None, order
+    canonical = canonical_form(tuple(value for row in puzzle for value in row), order)
+    solution = cache.get(canonical, order)
+    if solution is None:
+        return None, canonical, order
+    return format_line(solution, order, alphanumeric), canonical, order
+
+
+def write_solutions(solutions, f):
+    for solution in solutions:
+        f.write(solution + "\n")
+    f.flush()
+
+
+def solve_batch(input_path, output_path, processes=None, use_mmap=False, cache_path=None):
+    """
+    Streams the puzzles in input_path through a pool of processes and the solutions to
+    output_path in the same order. A path of '-' means stdin or stdout. With cache_path,
+    solutions are looked up in and added to the SolutionCache stored there
+    """
+    input_file = sys.stdin if input_path == "-" else open(input_path, 'r')
+    output_file = sys.stdout if output_path == "-" else open(output_path, 'w')
+    cache = cache_path and SolutionCache(cache_path)
+    try:
+        puzzles = read_puzzles(input_file, use_mmap)
+        write_solutions(solve_puzzles(puzzles, processes, cache), output_file)
+        if cache is not None:
+            cache.save()
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+
+
+# Configurations raced by solve_portfolio, as (name, Sudoku attribute settings). String values
+# are the names of Sudoku constants
+PORTFOLIO_CONFIGURATIONS = (
+    ("dlx", {"solve_engine": "DLX_ENGINE"}),
+    ("gac", {"solve_engine": "CSP_ENGINE",
+             "domain_representation": "BITMASK_DOMAINS",
+             "variable_heuristic": "MOST_CONSTRAINED_VAR_BUCKETS",
+             "value_heuristic": "LEAST_CONSTRAINING_VAL_COUNTS",
+             "inference_heuristic": "ALL_DIFFERENT_GAC"}),
+    ("rules-cbj", {"solve_engine": "CSP_ENGINE",
+                   "domain_representation": "BITMASK_DOMAINS",
+                   "variable_heuristic": "DOM_WDEG",
+                   "inference_heuristic": "RULE_PROPAGATION",
+                   "search_algorithm": "CONFLICT_DIRECTED_BACKJUMPING"}),
+    ("fc-restarts", {"solve_engine": "CSP_ENGINE",
+                     "domain_representation": "BITMASK_DOMAINS",
+                     "variable_heuristic": "DOM_WDEG",
+                     "inference_heuristic": "FORWARD_CHECKING",
+                     "restart_schedule": "LUBY_RESTARTS",
+                     "random_tie_breaking": True,
+                     "seed": 0}),
+)
+
+
+def configure(sudoku, settings):
+    for name, value in settings.items():
+        if isinstance(value, str):
+            value = getattr(Sudoku, value)
+        setattr(sudoku, name, value)
+
+
+def run_portfolio_member(puzzle, order, index, settings, results):
+    """
+    Solves puzzle with one portfolio configuration and puts (index, solved state or None) on
+    the results queue, also if the configuration raises
+    """
+    ans = None
+    try:
+        sudoku = Sudoku(puzzle, order)
+        configure(sudoku, settings)
+        ans = sudoku.find_solution()
+    finally:
+        results.put((index, ans))
+
+
+def solve_portfolio(puzzle, order=3, configurations=PORTFOLIO_CONFIGURATIONS):
+    """
+    Solves puzzle with every configuration at once, one process each. Returns (solved state,
+    name of the configuration that found it) as soon as one of them finishes with a solution,
+    terminating the others, or (None, None) once all of them found there is none or died.
+    The winner is logged to stderr
+    """
+    start = time.time()
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_portfolio_member,
+                                         args=(puzzle, order, index, settings, results))
+                 for index, (name, settings) in enumerate(configurations)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+    finished = set()
+    try:
+        while len(finished) < len(processes):
+            try:
+                index, ans = results.get(timeout=PORTFOLIO_POLL_INTERVAL)
+            except Empty:
+                # A member that exited with an error code, e.g. because it was killed, never
+                # found a solution and may not have posted a result, so it counts as finished
+                for index, process in enumerate(processes):
+                    if process.exitcode not in (None, 0):
+                        finished.add(index)
+                continue
+            finished.add(index)
+            if ans is not None:
+                name = configurations[index][0]
+                sys.stderr.write("Portfolio won by {0} in {1:.3f}s\n".format(name, time.time() - start))
+                return ans, name
+        return None, None
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+# Settings of the Sudoku solving each subproblem of solve_parallel, as in PORTFOLIO_CONFIGURATIONS
+PARALLEL_SEARCH_SETTINGS = {"solve_engine": "CSP_ENGINE",
+                            "domain_representation": "BITMASK_DOMAINS",
+                            "variable_heuristic": "MOST_CONSTRAINED_VAR_BUCKETS",
+                            "value_heuristic": "LEAST_CONSTRAINING_VAL_COUNTS",
+                            "inference_heuristic": "ALL_DIFFERENT_GAC"}
+
+
+def split_search(puzzle, order, settings, count, max_depth=PARALLEL_MAX_SPLIT_DEPTH):
+    """
+    Expands the top of the search tree of puzzle level by level until there are at least count
+    open nodes, or max_depth levels have been split. Returns (solved state, None) if a solution
+    turns up while expanding, otherwise (None, subproblems) with the (state, masks) pairs of
+    the open nodes in search order
+    """
+    subproblems = [(puzzle, None)]
+    depth = 0
+    while 0 < len(subproblems) < count and depth < max_depth:
+        # Levels with a single open node only assign a forced variable, so they are not counted
+        if len(subproblems) > 1:
+            depth += 1
+        children = []
+        for state, masks in subproblems:
+            sudoku = Sudoku([row[:] for row in state], order)
+            configure(sudoku, settings)
+            sudoku.initial_masks = masks
+            for child_state, child_masks in sudoku.expand_root():
+                if all(value != 0 for row in child_state for value in row):
+                    return child_state, None
+                children.append((child_state, child_masks))
+        subproblems = children
+    return None, subproblems
+
+
+def solve_subproblem(args):
+    state, masks, order, settings = args
+    sudoku = Sudoku(state, order)
+    configure(sudoku, settings)
+    sudoku.initial_masks = masks
+    return sudoku.find_solution()
+
+
+def solve_parallel(puzzle, order=3, processes=None, settings=PARALLEL_SEARCH_SETTINGS):
+    """
+    Solves a single puzzle on a pool of processes (one per core by default). The top of the
+    search tree is split into PARALLEL_SUBPROBLEMS_PER_PROCESS subproblems per process, which
+    idle workers take one at a time in search order. Returns the first solution found, stopping
+    every worker, or None if no subproblem has one
+    """
+    processes = processes or multiprocessing.cpu_count()
+    ans, subproblems = split_search(puzzle, order, settings, processes * PARALLEL_SUBPROBLEMS_PER_PROCESS)
+    if ans is not None or not subproblems:
+        return ans
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        tasks = ((state, masks, order, settings) for state, masks in subproblems)
+        for ans in pool.imap_unordered(solve_subproblem, tasks):
+            if ans is not None:
+                return ans
+        return None
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def random_full_grid(order, rng):
+    """
+    Returns a random solved grid, found by searching from an empty puzzle with randomly ordered
+    values and random tie breaking
+    """
+    size = order * order
+    sudoku = Sudoku([[0] * size for row in range(size)], order)
+    sudoku.solve_engine = Sudoku.CSP_ENGINE
+    sudoku.domain_representation = Sudoku.BITMASK_DOMAINS
+    sudoku.inference_heuristic = Sudoku.FORWARD_CHECKING
+    sudoku.value_heuristic = Sudoku.RANDOM_SHUFFLE
+    sudoku.random_tie_breaking = True
+    sudoku.seed = rng.random()
+    return sudoku.find_solution()
+
+
+def removal_groups(size, symmetry):
+    """
+    Returns the groups of (row, col) cells that are removed together under symmetry
+    """
+    groups = set()
+    for row in range(size):
+        for col in range(size):
+            if symmetry == ROTATIONAL_SYMMETRY:
+                other = (size - 1 - row, size - 1 - col)
+            elif symmetry == DIAGONAL_SYMMETRY:
+                other = (col, row)
+            else:
+                other = (row, col)
+            groups.add(tuple(sorted(set([(row, col), other]))))
+    return sorted(groups)
+
+
+def generate_puzzle(order=3, target_clues=None, symmetry=NO_SYMMETRY, seed=None):
+    """
+    Returns a puzzle with a unique solution. Clues of a random full grid are removed one group
+    at a time in random order, putting back any group whose removal leaves more than one
+    solution, until at most target_clues are left. Without a target every group is tried once,
+    so no group of the result can be removed
+    """
+    rng = random.Random(seed)
+    size = order * order
+    puzzle = random_full_grid(order, rng)
+    clues = size * size
+    groups = removal_groups(size, symmetry)
+    rng.shuffle(groups)
+
+    for group in groups:
+        if target_clues is not None and clues <= target_clues:
+            break
+        values = [puzzle[row][col] for row, col in group]
+        for row, col in group:
+            puzzle[row][col] = 0
+        if Sudoku(puzzle, order).is_unique():
+            clues -= len(group)
+        else:
+            for (row, col), value in zip(group, values):
+                puzzle[row][col] = value
+    return puzzle
+
+
+def generate_line(args):
+    """
+    Returns generate_puzzle(*args) written on a single line, see format_line
+    """
+    order = args[0]
+    puzzle = generate_puzzle(*args)
+    return format_line([value for row in puzzle for value in row], order, False)
+
+
+def generate_puzzles(count, order=3, target_clues=None, symmetry=NO_SYMMETRY, seed=None,
+                     processes=None):
+    """
+    Yields count generated puzzles as single lines, generating them on a pool of processes (one
+    per core by default). The i-th puzzle is generated from seed + i, so a seeded run is
+    reproducible whatever the number of processes
+    """
+    if seed is None:
+        seed = random.randrange(1 << 32)
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    try:
+        tasks = ((order, target_clues, symmetry, seed + i) for i in range(count))
+        for line in pool.imap(generate_line, tasks, GENERATE_CHUNK_SIZE):
+            yield line
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def generate_batch(count, output_path, order=3, target_clues=None, symmetry=NO_SYMMETRY, seed=None,
+                   processes=None):
+    """
+    Writes count generated puzzles to output_path, one per line. A path of '-' means stdout
+    """
+    output_file = sys.stdout if output_path == "-" else open(output_path, 'w')
+    try:
+        write_solutions(generate_puzzles(count, order, target_clues, symmetry, seed, processes),
+                        output_file)
+    finally:
+        if output_file is not sys.stdout:
+            output_file.close()
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        use_mmap = "--mmap" in sys.argv
+        paths = [arg for arg in sys.argv[2:] if arg != "--mmap"]
+        cache_path = None
+        if "--cache" in paths[:-1]:
+            i = paths.index("--cache")
+            cache_path = paths[i + 1]
+            paths = paths[:i] + paths[i + 2:]
+        if len(paths) != 2:
+            raise ValueError("Wrong number of arguments!")
+        solve_batch(paths[0], paths[1], use_mmap=use_mmap, cache_path=cache_path)
+        sys.exit()
+
+    if len(sys.argv) > 1 and sys.argv[1] in ("--portfolio", "--parallel"):
+        if len(sys.argv) != 4:
+            raise ValueError("Wrong number of arguments!")
+        with open(sys.argv[2], 'r') as f:
+            puzzle, order, alphanumeric = parse_puzzle(f.readlines())
+        if sys.argv[1] == "--portfolio":
+            ans, winner = solve_portfolio(puzzle, order)
+        else:
+            ans = solve_parallel(puzzle, order)
+        with open(sys.argv[3], 'a') as f:
+            if ans is None:
+                f.write("Did not solve :(\n")
+            else:
+                for row in ans:
+                    f.write(" ".join(format_value(value, alphanumeric) for value in row) + " \n")
+        sys.exit()
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--generate":
+        options = {"--clues": None, "--symmetry": None, "--seed": None}
+        args = []
+        i = 2
+        while i < len(sys.argv):
+            if sys.argv[i] in options and i + 1 < len(sys.argv):
+                options[sys.argv[i]] = sys.argv[i + 1]
+                i += 2
+            else:
+                args.append(sys.argv[i])
+                i += 1
+        if len(args) != 2:
+            raise ValueError("Wrong number of arguments!")
+        symmetries = {None: NO_SYMMETRY, "rotational": ROTATIONAL_SYMMETRY, "diagonal": DIAGONAL_SYMMETRY}
+        if options["--symmetry"] not in symmetries:
+            raise ValueError("Unknown symmetry: {0}".format(options["--symmetry"]))
+        clues = options["--clues"] and int(options["--clues"])
+        seed = options["--seed"] and int(options["--seed"])
+        generate_batch(int(args[0]), args[1], target_clues=clues, symmetry=symmetries[options["--symmetry"]],
+                       seed=seed)
+        sys.exit()
+
     # STRICTLY do NOT modify the code in the main function here
     if len(sys.argv) != 3:
-        print ("\nUsage: python CS3243_P2_Sudoku_XX.py input.txt output.txt\n")
+        print ("\nUsage: python CS3243_P2_Sudoku_XX.py input.txt output.txt\n"
+               "       python CS3243_P2_Sudoku_XX.py --batch [--mmap] [--cache cache.txt] puzzles.txt solutions.txt\n"
+               "       python CS3243_P2_Sudoku_XX.py --portfolio input.txt output.txt\n"
+               "       python CS3243_P2_Sudoku_XX.py --parallel input.txt output.txt\n"
+               "       python CS3243_P2_Sudoku_XX.py --generate COUNT [--clues N] [--symmetry rotational|diagonal]"
+               " [--seed S] puzzles.txt\n")
         raise ValueError("Wrong number of arguments!")
 
     try:
@@ -426,24 +2849,13 @@ if __name__ == "__main__":
         print ("\nUsage: python CS3243_P2_Sudoku_XX.py input.txt output.txt\n")
         raise IOError("Input file not found!")
 
-    puzzle = [[0 for i in range(9)] for j in range(9)]
-    lines = f.readlines()
-
-    i, j = 0, 0
-    for line in lines:
-        for number in line:
-            if '0' <= number <= '9':
-                puzzle[i][j] = int(number)
-                j += 1
-                if j == 9:
-                    i += 1
-                    j = 0
+    puzzle, order, alphanumeric = parse_puzzle(f.readlines())
 
-    sudoku = Sudoku(puzzle)
+    sudoku = Sudoku(puzzle, order)
     ans = sudoku.solve()
 
     with open(sys.argv[2], 'a') as f:
-        for i in range(9):
-            for j in range(9):
-                f.write(str(ans[i][j]) + " ")
+        for i in range(len(ans)):
+            for j in range(len(ans)):
+                f.write(format_value(ans[i][j], alphanumeric) + " ")
             f.write("\n")
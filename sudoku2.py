@@ -1,68 +1,119 @@
 import sys
 import copy
+import bisect
 import random
 
 # Running script: given code can be run with the command:
 # python file.py, ./path/to/init_state.txt ./output/output.txt
 
+# Largest value written as a letter (Z), so boards of order 6 and up are written with numbers only
+MAX_LETTER_VALUE = 35
+
 """Keeps track of unassigned variables.
 Kept as a separate class from Sudoku. 
 It does not need to be reinitialised with Sudoku."""
 class Tracker(object):
-    def __init__(self, state):
-        most_constrained_vars = []#store unassigned_vars with samllest domains.
-        self.row_tracker = []; #stores coordinates of unassigned variables according to row.
-        self.col_tracker = []; #stores coordinates of unassigned variables according to row.
-        self.box_tracker = []; #stores coordinates of unassigned variables according to 3x3 square.
-        for index in range(9):
-            self.row_tracker.append([])
-            self.col_tracker.append([])
-            self.box_tracker.append([])
-        for row in range(9):
-            for col in range(9):
+    def __init__(self, state, order=3):
+        self.most_constrained_vars = [] #store unassigned_vars with samllest domains.
+        self.order = order #size of each box; the puzzle has order * order rows, columns and boxes.
+        self.size = order * order
+        # bitsets of unassigned variables in each row/ col/ box. Bit row * size + col is set while (row, col) is unassigned.
+        self.row_bits = [0] * self.size
+        self.col_bits = [0] * self.size
+        self.box_bits = [0] * self.size
+        # number of unassigned variables in each row/ col/ box, used by count_neighbours().
+        self.row_counts = [0] * self.size
+        self.col_counts = [0] * self.size
+        self.box_counts = [0] * self.size
+        # number of unassigned variables in the part of each row/ col that lies in a box, indexed by row, box col and col, box row.
+        self.row_segment_counts = [[0] * order for index in range(self.size)]
+        self.col_segment_counts = [[0] * order for index in range(self.size)]
+        for row in range(self.size):
+            for col in range(self.size):
                 if state[row][col] == 0:
-                    self.row_tracker[row].append((row, col))
-                    self.col_tracker[col].append((row, col)) 
-                    self.box_tracker[(row // 3) * 3 + col // 3].append((row, col))
+                    self.add(row, col)
     
     #called in select_unassigned_variable()
     def get_most_constrained_vars(self):
         return self.most_constrained_vars
     
-    #called in init_domain()
+    #called in update_most_constrained_vars()
     def set_most_constrained_vars(self, vars):
         self.most_constrained_vars = vars;
 
-    #returns a set of all unassigned variables in the same row/ column/ box as the input coordinates.
+    #called in order_domain_values()
+    def get_unit_value_counts(self):
+        return self.unit_value_counts
+
+    #called in track_domains()
+    def set_unit_value_counts(self, counts):
+        self.unit_value_counts = counts
+
+    #called in inference() and restore_domains()
+    def get_domain_size_buckets(self):
+        return self.domain_size_buckets
+
+    #called in track_domains()
+    def set_domain_size_buckets(self, buckets):
+        self.domain_size_buckets = buckets #buckets[n] is the set of unassigned variables with n values in their domain.
+
+    #returns a list of all unassigned variables in the same row/ column/ box as the input coordinates.
     def get_neighbours(self, row_num, col_num):
-        var_set = set()
-        square_num = (row_num // 3) * 3 + col_num // 3
-        for coordinates in self.row_tracker[row_num]:
-            var_set.add(coordinates)
-        for coordinates in self.col_tracker[col_num]:
-            var_set.add(coordinates)    
-        for coordinates in self.box_tracker[square_num]:
-            var_set.add(coordinates)
-        return var_set
+        square_num = self.get_box(row_num, col_num)
+        return self.get_vars(self.row_bits[row_num] | self.col_bits[col_num] | self.box_bits[square_num])
+
+    #returns len(get_neighbours(row_num, col_num)) without building the list.
+    def count_neighbours(self, row_num, col_num):
+        square_num = self.get_box(row_num, col_num)
+        # inclusion-exclusion over row, col and box: the row and col only meet at (row_num, col_num), which is also in the box.
+        return (self.row_counts[row_num] + self.col_counts[col_num] + self.box_counts[square_num]
+            - self.row_segment_counts[row_num][col_num // self.order]
+            - self.col_segment_counts[col_num][row_num // self.order])
 
     #called when assigning a blanck space a value.
     def remove(self, row_num, col_num):
-        self.row_tracker[row_num].remove((row_num, col_num))
-        self.col_tracker[col_num].remove((row_num, col_num))
-        self.box_tracker[(row_num // 3) * 3 + col_num // 3].remove((row_num, col_num))
-    
+        self.update(row_num, col_num, -1)
+
     def add(self, row_num, col_num):
-        self.row_tracker[row_num].append((row_num, col_num))
-        self.col_tracker[col_num].append((row_num, col_num))
-        self.box_tracker[(row_num // 3) * 3 + col_num // 3].append((row_num, col_num))
+        self.update(row_num, col_num, 1)
+
+    #marks (row_num, col_num) as unassigned if change is 1 and as assigned if change is -1.
+    def update(self, row_num, col_num, change):
+        square_num = self.get_box(row_num, col_num)
+        bit = 1 << (row_num * self.size + col_num)
+        if change == 1:
+            self.row_bits[row_num] |= bit
+            self.col_bits[col_num] |= bit
+            self.box_bits[square_num] |= bit
+        else:
+            self.row_bits[row_num] &= ~bit
+            self.col_bits[col_num] &= ~bit
+            self.box_bits[square_num] &= ~bit
+        self.row_counts[row_num] += change
+        self.col_counts[col_num] += change
+        self.box_counts[square_num] += change
+        self.row_segment_counts[row_num][col_num // self.order] += change
+        self.col_segment_counts[col_num][row_num // self.order] += change
+
+    #returns the coordinates of the variables in a bitset, in row-major order.
+    def get_vars(self, bits):
+        coordinates = []
+        while bits:
+            lowest_bit = bits & -bits
+            index = lowest_bit.bit_length() - 1
+            coordinates.append((index // self.size, index % self.size))
+            bits ^= lowest_bit
+        return coordinates
+
+    def get_box(self, row_num, col_num):
+        return (row_num // self.order) * self.order + col_num // self.order
     
-    #returns set of coordinates for all unassigned variables.
+    #returns list of coordinates for all unassigned variables.
     def get_unassigned_vars(self):
-        var_set = set();
-        for index in range(9):
-            for coordinates in self.row_tracker[index]:
-                var_set.add(coordinates)
-        return var_set
+        bits = 0
+        for row_bits in self.row_bits:
+            bits |= row_bits
+        return self.get_vars(bits)
 
         
 class Sudoku(object):
@@ -80,19 +131,28 @@ class Sudoku(object):
     COL = 1
     BOX = 2
 
-    def __init__(self, puzzle):
+    def __init__(self, puzzle, order=3):
         # you may add more attributes if you need
         self.puzzle = puzzle # self.puzzle is a list of lists
-        
+        self.order = order # size of each box, i.e. the puzzle has order * order rows, columns, boxes and values
+        self.size = order * order
+        # use run_iterative_back_tracking instead of the recursive run_back_tracking
+        self.iterative = False
+        # index passed to order_domain_values, see there
+        self.value_heuristic = 1
+
     def solve(self):
         # initialise tracker
-        tracker = Tracker(self.puzzle)
+        tracker = Tracker(self.puzzle, self.order)
+        # changes made by inference, undone by restore_domains
+        self.trail = []
+        self.trail_marks = []
         domains = self.init_domains(self.puzzle, tracker)
         # check what the initial domains look like
         self.check_initial_domain(domains)
         state = copy.deepcopy(self.puzzle)
 
-        ans = self.run_back_tracking(state, domains, tracker)
+        ans = self.search(state, domains, tracker)
 
         # check final ans
         for row in ans:
@@ -101,7 +161,6 @@ class Sudoku(object):
         return ans
 
     def run_back_tracking(self, state, domains, tracker):
-        initial_domain = domains
         if self.is_goal_state(state):
             return state
 
@@ -112,7 +171,7 @@ class Sudoku(object):
         tracker.remove(var_row, var_col) #update tracker here 
 
         # HEURISTIC HERE
-        sorted_domain = self.order_domain_values(domains, var, tracker, 1)
+        sorted_domain = self.order_domain_values(domains, var, tracker, self.value_heuristic)
         iter = 0 #test if iteration of sorted_domain is sequential. To be removed.
         for value in sorted_domain:
             print("var selected: (" + str(var_row) + "," + str(var_col) + ")")
@@ -124,7 +183,7 @@ class Sudoku(object):
             print("tracker: " + str(tracker.get_unassigned_vars()))
             if self.is_legal_assignment(value, var, state):
                 state[var_row][var_col] = value
-                for i in range(9):
+                for i in range(self.size):
                     print(state[i])
                 print()
                 # inferences return new list of domains
@@ -136,12 +195,56 @@ class Sudoku(object):
 
                     if result != None:
                         return result
+                self.restore_domains(domains, tracker)
             state[var_row][var_col] = 0
-            domains = initial_domain
         #print("assignment to (" + str(var_row) + "," + str(var_col) + ") failed")
         tracker.add(var_row, var_col) #revert changes to tracker
         return None
 
+    def search(self, state, domains, tracker):
+        if self.iterative:
+            return self.run_iterative_back_tracking(state, domains, tracker)
+        return self.run_back_tracking(state, domains, tracker)
+
+    def run_iterative_back_tracking(self, state, domains, tracker):
+        """
+        Same search as run_back_tracking, with a stack of [var, sorted domain, index of the next
+        value, domains] frames instead of recursion so that large boards do not hit the
+        recursion limit
+        """
+        stack = []
+        while True:
+            # domains is None unless the last assignment succeeded and a new node is to be expanded
+            if domains is not None:
+                if self.is_goal_state(state):
+                    return state
+                var = self.select_unassigned_variable(state, domains, tracker, 2)
+                tracker.remove(var[self.ROW], var[self.COL])
+                sorted_domain = self.order_domain_values(domains, var, tracker, self.value_heuristic)
+                stack.append([var, sorted_domain, 0, domains])
+                domains = None
+
+            if len(stack) == 0:
+                return None
+            frame = stack[-1]
+            var, sorted_domain, index, node_domains = frame
+            var_row = var[self.ROW]
+            var_col = var[self.COL]
+            if state[var_row][var_col] != 0:
+                # undo the inference of the value tried last
+                self.restore_domains(node_domains, tracker)
+            state[var_row][var_col] = 0
+            if index == len(sorted_domain):
+                tracker.add(var_row, var_col)
+                stack.pop()
+                continue
+            frame[2] = index + 1
+
+            value = sorted_domain[index]
+            if self.is_legal_assignment(value, var, state):
+                state[var_row][var_col] = value
+                domains = self.inference(state, node_domains, var, tracker)
+
     def select_unassigned_variable(self, state, domains, tracker, index):
         """
         index == 0 -> select first unassigned variable.
@@ -149,8 +252,8 @@ class Sudoku(object):
         index == 2 -> most constraining with most constrained as tie-breaker.
         """ 
         if (index == 0):
-            for row in range(9):
-                for col in range(9):
+            for row in range(self.size):
+                for col in range(self.size):
                     if state[row][col] == 0:
                         box = self.get_box(row, col)
                         return (row, col, box)
@@ -164,21 +267,21 @@ class Sudoku(object):
                     #print("tie")
                     #print("comparing " + str(most_constrained_var) + " to " + str(var))
                     #print(tracker.get_neighbours(row_num, col_num))
-                    if len(tracker.get_neighbours(var_row, var_col)) > len(tracker.get_neighbours(most_constrained_var[self.ROW], most_constrained_var[self.COL])):
+                    if tracker.count_neighbours(var_row, var_col) > tracker.count_neighbours(most_constrained_var[self.ROW], most_constrained_var[self.COL]):
                         most_constrained_var = var;
                     #print(var selected: " + str(most_constrained_var))
             row_num = most_constrained_var[self.ROW] 
             col_num = most_constrained_var[self.COL]
             return (row_num, col_num, self.get_box(row_num, col_num))
         elif (index == 2):
-            unassigned_var_list = list(set(tracker.get_unassigned_vars()))
+            unassigned_var_list = tracker.get_unassigned_vars()
             if (len(unassigned_var_list) > 0):
                 max_num_constrains = -1 #number of variables constrained by most-constraining-variable.
                 most_constraining_var = (-1, -1)
                 for unassigned_variable in unassigned_var_list:
                     row_num = unassigned_variable[0]
                     col_num = unassigned_variable[1]
-                    num_constrains = len(tracker.get_neighbours(row_num, col_num))
+                    num_constrains = tracker.count_neighbours(row_num, col_num)
                     if (num_constrains > max_num_constrains):
                         print("old most constraining var: " + str(most_constraining_var) + ", num constraints: " + str(max_num_constrains))
                         print("old number of constraints: " + str(max_num_constrains) + " new number of constraints: " + str(num_constrains))
@@ -198,6 +301,9 @@ class Sudoku(object):
         """
         index == 0 => randomly sort the domain
         index == 1 => least constraining value
+        index == 2 => least constraining value, using the unit value counts kept by inference() and
+                      restore_domains(). Cells in both the box and the row or col are counted twice,
+                      so values can be ordered differently from index == 1
         """
         var_row = var[self.ROW]
         var_col = var[self.COL]
@@ -207,7 +313,7 @@ class Sudoku(object):
             random.shuffle(domain)
             return domain
         if index == 1:            
-            value_occurence_counter = [0] * 9 #list that keeps track of number of times each value occurs accross the domains of unassigned variables in var_row/ var_col/ var_box.
+            value_occurence_counter = [0] * self.size #list that keeps track of number of times each value occurs accross the domains of unassigned variables in var_row/ var_col/ var_box.
             #print(value_occurence_counter)
             neighbours = tracker.get_neighbours(var_row, var_col)
             for neighbour in neighbours:
@@ -223,15 +329,84 @@ class Sudoku(object):
             #print("sorted_values: " + str(sorted_values))
             domain = [tup[0] for tup in sorted_values]
             return domain
+        if index == 2:
+            row_value_counts, col_value_counts, box_value_counts = tracker.get_unit_value_counts()
+            var_box = var[self.BOX]
+            sorted_values = [] #list of tuples to be sorted in ascending order accoring to occurence.
+            for value in domain:
+                occurence = row_value_counts[var_row][value - 1] + col_value_counts[var_col][value - 1] + box_value_counts[var_box][value - 1]
+                sorted_values.append((value, occurence))
+            sorted_values.sort(key = lambda tup: tup[1])
+            domain = [tup[0] for tup in sorted_values]
+            return domain
             
 
     def inference(self, state, domains, var, tracker):
         """
-        For now just remove the domain of the current var and return the new
-        domains. NOTE: DEEPCOPY THE DOMAIN!!
+        Removes the value assigned to var from the domains of its unassigned neighbours in
+        place and updates the unit value counts and most constrained variables in tracker,
+        instead of rebuilding every domain. Changes are pushed onto self.trail for
+        restore_domains
+        """
+        var_row = var[self.ROW]
+        var_col = var[self.COL]
+        value = state[var_row][var_col]
+        buckets = tracker.get_domain_size_buckets()
+        domain = domains[var_row][var_col]
+        self.trail_marks.append((len(self.trail), var_row, var_col, domain))
+        buckets[len(domain)].remove((var_row, var_col))
+        self.count_domain_values(tracker, var_row, var_col, domain, -1)
+        domains[var_row][var_col] = 0 # assign domain value 0 if variable is assigned
+        for (row, col) in tracker.get_neighbours(var_row, var_col):
+            neighbour_domain = domains[row][col]
+            if value in neighbour_domain:
+                buckets[len(neighbour_domain)].remove((row, col))
+                neighbour_domain.remove(value)
+                buckets[len(neighbour_domain)].add((row, col))
+                self.count_domain_values(tracker, row, col, [value], -1)
+                self.trail.append((row, col, value))
+        self.update_most_constrained_vars(tracker)
+        return domains
+
+    def restore_domains(self, domains, tracker):
+        """
+        Undoes the changes made by the last call to inference
+        """
+        mark, var_row, var_col, domain = self.trail_marks.pop()
+        buckets = tracker.get_domain_size_buckets()
+        while len(self.trail) > mark:
+            row, col, value = self.trail.pop()
+            neighbour_domain = domains[row][col]
+            buckets[len(neighbour_domain)].remove((row, col))
+            bisect.insort(neighbour_domain, value) # keep the domain sorted as init_domains builds it
+            buckets[len(neighbour_domain)].add((row, col))
+            self.count_domain_values(tracker, row, col, [value], 1)
+        domains[var_row][var_col] = domain
+        buckets[len(domain)].add((var_row, var_col))
+        self.count_domain_values(tracker, var_row, var_col, domain, 1)
+        self.update_most_constrained_vars(tracker)
+
+    def count_domain_values(self, tracker, row, col, values, change):
+        """
+        Adds change to the unit value counts of the row, col and box of (row, col) for each value
+        """
+        row_value_counts, col_value_counts, box_value_counts = tracker.get_unit_value_counts()
+        box = self.get_box(row, col)
+        for value in values:
+            row_value_counts[row][value - 1] += change
+            col_value_counts[col][value - 1] += change
+            box_value_counts[box][value - 1] += change
+
+    def update_most_constrained_vars(self, tracker):
+        """
+        Sets the unassigned variables with the smallest domain, in row-major order, from the
+        domain size buckets
         """
-        new_domains = self.init_domains(state, tracker)
-        return new_domains
+        for bucket in tracker.get_domain_size_buckets():
+            if len(bucket) > 0:
+                tracker.set_most_constrained_vars(sorted(bucket))
+                return
+        tracker.set_most_constrained_vars([])
 
     def is_goal_state(self, state):
         """
@@ -252,18 +427,19 @@ class Sudoku(object):
                 return False
 
         # check col constraints
-        for index in range(9):
+        for index in range(self.size):
             if state[index][var[self.COL]] == value:
                 #print("illegal assignment")
                 return False
 
         # check box constraints
+        order = self.order
         box = var[self.BOX]
-        box_row = box // 3
-        box_col = box % 3
+        box_row = box // order
+        box_col = box % order
 
-        for row in range(box_row*3, box_row*3+3):
-            for col in range(box_col*3, box_col*3+3):
+        for row in range(box_row*order, box_row*order+order):
+            for col in range(box_col*order, box_col*order+order):
                 if value == state[row][col]:
                     #print("illegal assignment")
                     return False
@@ -272,18 +448,16 @@ class Sudoku(object):
 
     def init_domains(self, state, tracker):
         """
-        Returns the domains of a particular state
+        Returns the domains of a particular state. Only called for the initial state, as
+        inference updates the domains incrementally afterwards
         """
-        # initialize as a 2d array of lists, representing domain of 1-9
-        domains = [[[i for i in range(1,10)] for j in range(9)] for k in range(9)]
+        # initialize as a 2d array of lists, representing domain of 1-size
+        domains = [[[i for i in range(1, self.size + 1)] for j in range(self.size)] for k in range(self.size)]
 
         # for each empty cell, check all 24 constraining neighbours, reduce
         # domain accordingly
-        min_domain_size = 10
-        most_constrained_vars = []
-        # idenitfy most constrained variable with smallest domain
-        for row in range(9):
-            for col in range(9):
+        for row in range(self.size):
+            for col in range(self.size):
                 var = (row, col, self.get_box(row,col))
                 val = state[row][col]
                 if val != 0:
@@ -291,19 +465,37 @@ class Sudoku(object):
                     continue
 
                 domain = domains[row][col]
-                domain, domain_size = self.check_row(var, domain, state, 9)
+                domain, domain_size = self.check_row(var, domain, state, self.size)
                 domain, domain_size = self.check_col(var, domain, state, domain_size)
                 domain, domain_size = self.check_box(var, domain, state, domain_size)
                 domains[row][col] = domain
-                if domain_size == min_domain_size:
-                    most_constrained_vars.append((row, col))
-                elif domain_size < min_domain_size:
-                    most_constrained_vars = [(row, col)]
-                    min_domain_size = domain_size
-        tracker.set_most_constrained_vars(most_constrained_vars)
-        #print("most_constrained_vars: " + str(most_constrained_vars))
+        self.track_domains(domains, tracker)
         return domains
 
+    def track_domains(self, domains, tracker):
+        """
+        Sets the unit value counts, domain size buckets and most constrained variables in
+        tracker from scratch for the given domains
+        """
+        # number of unassigned variables in each row/ col/ box with each value in their domain.
+        row_value_counts = [[0] * self.size for index in range(self.size)]
+        col_value_counts = [[0] * self.size for index in range(self.size)]
+        box_value_counts = [[0] * self.size for index in range(self.size)]
+        buckets = [set() for size in range(self.size + 1)]
+        for row in range(self.size):
+            for col in range(self.size):
+                domain = domains[row][col]
+                if domain == 0:
+                    continue
+                for value in domain:
+                    row_value_counts[row][value - 1] += 1
+                    col_value_counts[col][value - 1] += 1
+                    box_value_counts[self.get_box(row, col)][value - 1] += 1
+                buckets[len(domain)].add((row, col))
+        tracker.set_unit_value_counts((row_value_counts, col_value_counts, box_value_counts))
+        tracker.set_domain_size_buckets(buckets)
+        self.update_most_constrained_vars(tracker)
+
     def check_row(self, var, domain, state, domain_size):
         """
         Returns the reduced domain after checking row constraints
@@ -326,7 +518,7 @@ class Sudoku(object):
         """
         new_domain = copy.copy(domain)
         col = var[self.COL]
-        for row in range(9):
+        for row in range(self.size):
             val = state[row][col]
             if val == 0:
                 continue
@@ -342,12 +534,13 @@ class Sudoku(object):
         Returns the reduced domain after checking box constraints
         """
         new_domain = copy.copy(domain)
+        order = self.order
         box = var[self.BOX]
-        box_row = box // 3
-        box_col = box % 3
+        box_row = box // order
+        box_col = box % order
 
-        for row in range(box_row*3, box_row*3+3):
-            for col in range(box_col*3, box_col*3+3):
+        for row in range(box_row*order, box_row*order+order):
+            for col in range(box_col*order, box_col*order+order):
                 val = state[row][col]
                 if val == 0:
                     continue
@@ -360,22 +553,22 @@ class Sudoku(object):
 
     def get_box(self, row, col):
         """
-        Get box number from row and col indices. Box number range from 0-8
+        Get box number from row and col indices. Box number range from 0 to size - 1
         """
-        box_row = row // 3
-        box_col = col // 3
-        box = box_row * 3 + box_col
+        box_row = row // self.order
+        box_col = col // self.order
+        box = box_row * self.order + box_col
         return box
 
     def check_initial_domain(self, domains):
         print("Starting state:\n")
-        for i in range(9):
+        for i in range(self.size):
             print(self.puzzle[i])
         
         print("\nStarting domains:\n")
-        for i in range(9):
+        for i in range(self.size):
             row = ""
-            for j in range(9):
+            for j in range(self.size):
                 row += "{:20}".format(str(domains[i][j]))
             print(row)
 
@@ -384,6 +577,46 @@ class Sudoku(object):
     # Note that our evaluation scripts only call the solve method.
     # Any other methods that you write should be used within the solve() method.
 
+def parse_value(token):
+    """
+    Returns the value of a cell written as a number, a letter (A = 10, B = 11, ..., Z = 35) or
+    0 / '.' for an empty cell
+    """
+    if token == '.':
+        return 0
+    if token.isdigit():
+        return int(token)
+    if len(token) == 1 and token.isalpha():
+        return ord(token.upper()) - ord('A') + 10
+    raise ValueError("Invalid cell value: {0}".format(token))
+
+def format_value(value, alphanumeric):
+    if alphanumeric and 9 < value <= MAX_LETTER_VALUE:
+        return chr(ord('A') + value - 10)
+    return str(value)
+
+def parse_puzzle(lines):
+    """
+    Returns (puzzle, order, alphanumeric) read from lines. Cells are separated by whitespace,
+    or written one character per cell if no line contains more than one token. alphanumeric
+    is always False for boards with values above MAX_LETTER_VALUE, which have no letter
+    """
+    tokens = [line.split() for line in lines]
+    if all(len(line_tokens) <= 1 for line_tokens in tokens):
+        cells = [char for line in lines for char in line.strip()]
+    else:
+        cells = [token for line_tokens in tokens for token in line_tokens]
+
+    size = int(round(len(cells) ** 0.5))
+    order = int(round(size ** 0.5))
+    if order ** 4 != len(cells):
+        raise ValueError("Puzzle must have order ** 4 cells, got {0}!".format(len(cells)))
+
+    values = [parse_value(cell) for cell in cells]
+    puzzle = [values[row * size:(row + 1) * size] for row in range(size)]
+    alphanumeric = size <= MAX_LETTER_VALUE and any(cell.isalpha() for cell in cells)
+    return puzzle, order, alphanumeric
+
 if __name__ == "__main__":
     # STRICTLY do NOT modify the code in the main function here
     if len(sys.argv) != 3:
@@ -396,23 +629,12 @@ if __name__ == "__main__":
         print ("\nUsage: python CS3243_P2_Sudoku_XX.py input.txt output.txt\n")
         raise IOError("Input file not found!")
 
-    puzzle = [[0 for i in range(9)] for j in range(9)]
-    lines = f.readlines()
-
-    i, j = 0, 0
-    for line in lines:
-        for number in line:
-            if '0' <= number <= '9':
-                puzzle[i][j] = int(number)
-                j += 1
-                if j == 9:
-                    i += 1
-                    j = 0
+    puzzle, order, alphanumeric = parse_puzzle(f.readlines())
 
-    sudoku = Sudoku(puzzle)
+    sudoku = Sudoku(puzzle, order)
     ans = sudoku.solve()
     with open(sys.argv[2], 'a') as f:
-        for i in range(9):
-            for j in range(9):
-                f.write(str(ans[i][j]) + " ")
+        for i in range(len(ans)):
+            for j in range(len(ans)):
+                f.write(format_value(ans[i][j], alphanumeric) + " ")
             f.write("\n")